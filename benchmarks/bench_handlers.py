@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the res2tblBuilder, waphl-fq2ncbi and terraRunChecker Lambda handlers offline.
+AWS (S3, Batch, Secrets Manager, Glue, Athena) is replaced by a local stand-in (moto) and Terra by a synthetic workspace.
+Reports the latency of each handler stage, the number of AWS API calls and the peak memory for each scale.
+
+Note: the local stand-in cannot execute SQL, so res2tblBuilder is run with engine = 'local' and catalog = 'partitions'
+(the meta_alt queries of the local engine succeed without doing anything).
+Peak memory includes the objects held by the stand-in.
+"""
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import botocore.client
+from moto import mock_aws
+from moto.moto_api import state_manager
+
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGION = 'us-west-2'
+BUCKET = 'waphl-results'
+NCBI_BUCKET = 'waphl-ncbi'
+JOB_QUEUE = 'bench-queue'
+JOB_DEF = 'bench-def'
+
+# Handler stages that are timed (functions that do not exist in a handler are skipped)
+HANDLERS = {
+    'res2tblBuilder': {
+        'path': os.path.join(REPO, 'waphl-res2tbls', 'res2tblBuilder', 'lambda_function.py'),
+        'stages': ['list_meta', 'read_watermark', 'register_partitions', 'run_crawler', 'create_table_local',
+                   'create_table_athena', 'create_table_batch', 'write_report']
+    },
+    'fq2ncbi': {
+        'path': os.path.join(REPO, 'waphl-fq2ncbi', 'lambda_function.py'),
+        'stages': ['read_inventory', 'list_destination', 'read_watermark', 'read_queue', 'transfer_files', 'write_inventory', 'write_queue', 'write_watermark']
+    },
+    'terraRunChecker': {
+        'path': os.path.join(REPO, 'waphl-terra2res', 'terraRunChecker', 'lambda_function.py'),
+        'paths': [os.path.join(REPO, 'waphl-terra2res', 'bin')],
+        'stages': ['checkWorkspaces', 'find_new_runs', 'submit_new_runs']
+    }
+}
+
+#----- INSTRUMENTATION -----#
+# AWS API calls made by any client, by service and operation
+API_CALLS = Counter()
+_make_api_call = botocore.client.BaseClient._make_api_call
+
+def _counted_api_call(self, operation_name, api_params):
+    API_CALLS[f'{self.meta.service_model.service_name}.{operation_name}'] += 1
+    # the stand-in does not implement BatchGetQueryExecution, so it is answered one query at a time
+    if operation_name == 'BatchGetQueryExecution':
+        return {'QueryExecutions': [_make_api_call(self, 'GetQueryExecution', {'QueryExecutionId': qid})['QueryExecution']
+                                    for qid in api_params['QueryExecutionIds']],
+                'UnprocessedQueryExecutionIds': []}
+    return _make_api_call(self, operation_name, api_params)
+
+# Function for loading a handler module from its file
+def load_handler(name):
+    path = HANDLERS[name]['path']
+    paths = [os.path.dirname(path)] + HANDLERS[name].get('paths', [])
+    sys.path[0:0] = paths
+    spec = importlib.util.spec_from_file_location(f'bench_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    del sys.path[0:len(paths)]
+    return module
+
+# Function for wrapping the stages of a handler with timers
+def time_stages(module, stages, timings):
+    for stage in stages:
+        if not hasattr(module, stage):
+            continue
+        def timed(func, stage):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+            return wrapper
+        setattr(module, stage, timed(getattr(module, stage), stage))
+
+# Function for running a handler and measuring it
+def run_handler(name, module, event=None):
+    timings = {}
+    time_stages(module, HANDLERS[name]['stages'], timings)
+    API_CALLS.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        module.handler(event or {}, None)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'handler': name,
+        'seconds': round(total, 3),
+        'stages': {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        'api_calls': sum(API_CALLS.values()),
+        'api_calls_by_operation': dict(API_CALLS.most_common()),
+        'peak_memory_mb': round(peak / 1024 / 1024, 1),
+        'error': error
+    }
+
+#----- LOCAL AWS STAND-IN -----#
+# Function for creating the resources used by the handlers
+def setup_aws(n_workspaces):
+    s3 = boto3.client('s3', region_name=REGION)
+    for bucket in [BUCKET, NCBI_BUCKET]:
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': REGION})
+    s3.put_object(Bucket=BUCKET, Key='credentials/google.json', Body=b'{}')
+
+    # Batch
+    role = boto3.client('iam', region_name=REGION).create_role(RoleName='bench-batch', AssumeRolePolicyDocument='{}')['Role']['Arn']
+    batch = boto3.client('batch', region_name=REGION)
+    ce = batch.create_compute_environment(computeEnvironmentName='bench-ce', type='UNMANAGED', serviceRole=role)['computeEnvironmentArn']
+    batch.create_job_queue(jobQueueName=JOB_QUEUE, state='ENABLED', priority=1, computeEnvironmentOrder=[{'order': 1, 'computeEnvironment': ce}])
+    batch.register_job_definition(jobDefinitionName=JOB_DEF, type='container', containerProperties={'image': 'bench', 'vcpus': 1, 'memory': 128, 'command': ['true']})
+
+    # Glue (data table partitioned like the data tree)
+    glue = boto3.client('glue', region_name=REGION)
+    glue.create_database(DatabaseInput={'Name': 'waphl'})
+    glue.create_table(DatabaseName='waphl', TableInput={
+        'Name': 'data',
+        'StorageDescriptor': {'Columns': [], 'Location': f's3://{BUCKET}/data/'},
+        'PartitionKeys': [{'Name': k, 'Type': 'string'} for k in ['id', 'workflow', 'run', 'file', 'timestamp']]
+    })
+    glue.create_crawler(Name='bench-crawler', Role=role, Targets={'S3Targets': [{'Path': f's3://{BUCKET}/data/'}]})
+    state_manager.set_transition(model_name='glue::crawl', transition={'progression': 'immediate'})
+
+    # Secrets
+    secrets = boto3.client('secretsmanager', region_name=REGION)
+    secrets.create_secret(Name='waphl-res2tbl/2024125', SecretString=json.dumps({
+        'crawler': 'bench-crawler', 'database': 'waphl', 'bucket': BUCKET, 'key': 'tables',
+        'jobqueue': JOB_QUEUE, 'jobdef': JOB_DEF, 'engine': 'local', 'catalog': 'partitions'
+    }))
+    secrets.create_secret(Name='waphl-fq2ncbi/20250107', SecretString=json.dumps({
+        'sourceBucket': BUCKET, 'destBucket': NCBI_BUCKET
+    }))
+    secrets.create_secret(Name='waphl-terra2res/241121', SecretString=json.dumps({
+        'terra_project': 'bench-project',
+        'terra_workspaces': ",".join(f'bench-workspace-{i}' for i in range(n_workspaces)),
+        'aws_results_bucket': BUCKET, 'aws_job_queue': JOB_QUEUE, 'aws_job_def': JOB_DEF,
+        'google_credentials': f's3://{BUCKET}/credentials/google.json'
+    }))
+    return s3
+
+#----- SYNTHETIC TERRA WORKSPACE -----#
+class TerraResponse:
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+        self.text = json.dumps(body)
+    def json(self):
+        return self.body
+
+# Function for replacing the Firecloud API with synthetic workspaces
+## Each workspace has n_submissions submissions spread over n_entities tables
+def fake_firecloud(fapi, n_submissions, n_entities=20):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    def list_entity_types(project, workspace, *args, **kwargs):
+        return TerraResponse({f'entity_{i}': {'count': 96, 'idName': f'entity_{i}_id', 'attributeNames': ['fastq_1', 'fastq_2']} for i in range(n_entities)})
+    def list_submissions(project, workspace, *args, **kwargs):
+        return TerraResponse([{
+            'submissionId': f'{workspace}-{i:08d}',
+            'methodConfigurationName': 'TheiaProk_Illumina_PE',
+            'submissionEntity': {'entityType': f'entity_{i % n_entities}_set'},
+            'submissionDate': (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'status': 'Done',
+            'workflowStatuses': {'Succeeded': 96}
+        } for i in range(n_submissions)])
+    fapi.list_entity_types = list_entity_types
+    fapi.list_submissions = list_submissions
+    fapi._check_response_code = lambda response, codes: None
+    fapi._set_session = lambda: None
+
+#----- BENCHMARK -----#
+def benchmark(n_files, n_workspaces, n_submissions):
+    results = []
+    with mock_aws(config={'batch': {'use_docker': False}}):
+        s3 = setup_aws(n_workspaces)
+
+        # Synthetic data
+        start = time.perf_counter()
+        meta_files = synthetic.generate_meta(BUCKET, n_files)
+        synthetic.write_s3(s3, BUCKET, meta_files, data='recent')
+        print(f'{n_files} files ({len(meta_files)} meta files) generated in {time.perf_counter() - start:.1f} seconds')
+
+        # res2tblBuilder: full build, then a rebuild with unchanged inputs
+        res2tbl = load_handler('res2tblBuilder')
+        results.append(dict(run_handler('res2tblBuilder', res2tbl), run='full', files=n_files))
+        results.append(dict(run_handler('res2tblBuilder', res2tbl), run='unchanged', files=n_files))
+
+        # fq2ncbi: first transfer, then a repeat with everything transferred
+        fq2ncbi = load_handler('fq2ncbi')
+        results.append(dict(run_handler('fq2ncbi', fq2ncbi), run='first', files=n_files))
+        results.append(dict(run_handler('fq2ncbi', fq2ncbi), run='repeat', files=n_files))
+
+        # terraRunChecker
+        checker = load_handler('terraRunChecker')
+        fake_firecloud(importlib.import_module('firecloud.api'), n_submissions)
+        results.append(dict(run_handler('terraRunChecker', checker), run=f'{n_workspaces} workspaces', files=n_submissions))
+    return results
+
+# Function for printing a summary table of the results
+def print_results(results):
+    print(f'\n{"handler":<16}{"run":<16}{"files":>10}{"seconds":>10}{"API calls":>11}{"peak MB":>9}  stages')
+    for r in results:
+        stages = ", ".join(f'{stage}={seconds}s' for stage, seconds in r['stages'].items())
+        print(f'{r["handler"]:<16}{r["run"]:<16}{r["files"]:>10}{r["seconds"]:>10}{r["api_calls"]:>11}{r["peak_memory_mb"]:>9}  {stages}')
+        if r['error']:
+            print(f'  ERROR: {r["error"]}')
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='bench_handlers.py',
+                        description='Benchmark the WAPHL Lambda handlers against a local AWS stand-in.')
+    parser.add_argument('-s',
+                        '--scales',
+                        nargs = "*",
+                        type = int,
+                        default = [10000],
+                        help = 'Numbers of files to benchmark. Multiple scales separated by spaces can be supplied (e.g., 10000 100000 1000000) (Default: 10000).')
+    parser.add_argument('-w',
+                        '--workspaces',
+                        type = int,
+                        default = 4,
+                        help = 'Number of Terra workspaces checked by terraRunChecker (Default: 4)')
+    parser.add_argument('--submissions',
+                        type = int,
+                        default = 2000,
+                        help = 'Number of submissions in each Terra workspace (Default: 2000)')
+    parser.add_argument('-o',
+                        '--output',
+                        help = 'Save the results as JSON')
+    args = parser.parse_args()
+
+    #------ RUN ------#
+    os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    botocore.client.BaseClient._make_api_call = _counted_api_call
+    results = []
+    for n_files in args.scales:
+        results.extend(benchmark(n_files, args.workspaces, args.submissions))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
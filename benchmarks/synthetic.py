@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Generates synthetic WAPHL-Results data for benchmarking.
+Produces meta/*.csv files (as written by waphl-prod2res/waphl-terra2res) and, optionally, the files they describe
+under data/id=*/workflow=*/run=*/file=*/timestamp=*/.
+"""
+import argparse
+import os
+import random
+import time
+
+# Columns of the meta files
+META_COLUMNS = ['id', 'workflow', 'run', 'file', 'timestamp', 'origin', 'current']
+
+# Workflow names and the files each sample gets (sample-level files) or each run gets (id = 'null')
+WORKFLOWS = {
+    'PHoeNIx_v2': {'sample': ['{id}_R1_001.fastq.gz', '{id}_R2_001.fastq.gz', '{id}.scaffolds.fa.gz'], 'run': ['Phoenix_Summary.tsv']},
+    'TheiaProk_Illumina_PE': {'sample': ['{id}_R1.fastq.gz', '{id}_R2.fastq.gz', '{id}_contigs.fasta', '{id}.json'], 'run': ['terra_table.tsv']},
+    'RECAPP': {'sample': ['{id}_R1.fastq.gz', '{id}_R2.fastq.gz'], 'run': ['terra_table.tsv']},
+    'BaseSpace_Fetch': {'sample': ['{id}_R1.fastq.gz', '{id}_R2.fastq.gz'], 'run': ['terra_table.tsv']}
+}
+
+# Function for generating meta rows
+## n_files = total number of rows (files)
+## days = timestamps are spread over this many days before now
+## Returns a list of meta files, each a list of rows (dictionaries)
+def generate_meta(bucket, n_files, files_per_meta=500, samples_per_run=48, days=365, seed=1):
+    rng = random.Random(seed)
+    now = int(time.time())
+    meta_files = []
+    rows = []
+    n_run = 0
+    while n_files > 0:
+        # each run = one workflow, one timestamp and a set of samples
+        n_run += 1
+        workflow = rng.choice(list(WORKFLOWS))
+        run = f'run_{n_run:06d}'
+        timestamp = now - rng.randint(0, days*24*60*60)
+        files = [('null', f) for f in WORKFLOWS[workflow]['run']]
+        for i in range(samples_per_run):
+            sample = f'{2024000000 + n_run*1000 + i}-WA{rng.randint(1000000, 9999999)}'
+            files.extend([(sample, f.format(id=sample)) for f in WORKFLOWS[workflow]['sample']])
+        for sample, f in files[:n_files]:
+            rows.append({
+                'id': sample,
+                'workflow': workflow,
+                'run': run,
+                'file': f,
+                'timestamp': str(timestamp),
+                'origin': f'gs://fc-synthetic/submissions/{run}/{f}',
+                'current': f's3://{bucket}/data/id={sample}/workflow={workflow}/run={run}/file={f}/timestamp={timestamp}/{f}'
+            })
+            if len(rows) == files_per_meta:
+                meta_files.append(rows)
+                rows = []
+        n_files -= len(files)
+    if rows:
+        meta_files.append(rows)
+    return meta_files
+
+# Function for converting meta rows to CSV text
+def meta_to_csv(rows):
+    lines = [",".join(META_COLUMNS)] + [",".join(row[col] for col in META_COLUMNS) for row in rows]
+    return "\n".join(lines)
+
+# Function for selecting the files that should exist under data/
+## data = 'all', 'recent' (FASTQ files newer than recent_days) or 'none'
+def select_data(meta_files, data='recent', recent_days=30):
+    if data == 'none':
+        return []
+    timelimit = int(time.time()) - recent_days*24*60*60
+    return [row['current'] for rows in meta_files for row in rows
+            if data == 'all' or ('.fastq.gz' in row['file'] and int(row['timestamp']) > timelimit)]
+
+# Function for writing the synthetic data to an S3 bucket (e.g., a local stand-in)
+def write_s3(client, bucket, meta_files, data='recent', prefix=None):
+    prefix = prefix or f'{int(time.time())}'
+    for i, rows in enumerate(meta_files):
+        client.put_object(Bucket=bucket, Key=f'meta/{prefix}-{i:06d}.csv', Body=meta_to_csv(rows))
+    for path in select_data(meta_files, data):
+        client.put_object(Bucket=bucket, Key=path.replace(f's3://{bucket}/', ''), Body=b'@read\nACGT\n+\nIIII\n')
+
+# Function for writing the synthetic data to a local directory
+def write_local(outdir, bucket, meta_files, data='none', prefix=None):
+    prefix = prefix or f'{int(time.time())}'
+    os.makedirs(os.path.join(outdir, 'meta'), exist_ok=True)
+    for i, rows in enumerate(meta_files):
+        with open(os.path.join(outdir, 'meta', f'{prefix}-{i:06d}.csv'), 'w') as f:
+            f.write(meta_to_csv(rows))
+    for path in select_data(meta_files, data):
+        local = os.path.join(outdir, path.replace(f's3://{bucket}/', ''))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, 'w') as f:
+            f.write('@read\nACGT\n+\nIIII\n')
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='synthetic.py',
+                        description='Generate synthetic WAPHL-Results data (meta/*.csv and data/).')
+    parser.add_argument('-n',
+                        '--files',
+                        type = int,
+                        default = 10000,
+                        help = 'Number of files described by the meta files (Default: 10000)')
+    parser.add_argument('-o',
+                        '--outdir',
+                        default = 'synthetic',
+                        help = 'Output directory (Default: synthetic)')
+    parser.add_argument('-b',
+                        '--bucket',
+                        default = 'waphl-results',
+                        help = 'Bucket name used in the file paths (Default: waphl-results)')
+    parser.add_argument('--data',
+                        default = 'none',
+                        choices = ['all', 'recent', 'none'],
+                        help = 'Files to create under data/ (Default: none)')
+    args = parser.parse_args()
+
+    #------ GENERATE ------#
+    meta_files = generate_meta(args.bucket, args.files)
+    write_local(args.outdir, args.bucket, meta_files, args.data)
+    print(f'{sum(len(rows) for rows in meta_files)} files described in {len(meta_files)} meta files written to {args.outdir}')
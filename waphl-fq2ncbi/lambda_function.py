@@ -2,16 +2,224 @@
 Transfer FASTQ files to S3 bucket for uploading to NCBI
 """
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import random
 import time
 import csv
 import json
+import gzip
+
+# Number of parts of each multipart copy that are copied at the same time
+PART_CONCURRENCY = 4
+
+# Function for streaming the rows of the FASTQ table that are newer than timelimit
+## Rows are read line by line and matched by column name, so memory only depends on the number of recent rows
+## use_select = True filters the table on the server with S3 Select (falls back to streaming if unavailable)
+## The fallback is only used if S3 Select fails before the first row, otherwise rows would be returned twice
+def read_new_fastqs(client, bucket, key, timelimit, use_select=False):
+    if use_select:
+        started = False
+        try:
+            for row in select_new_fastqs(client, bucket, key, timelimit):
+                started = True
+                if is_newer(row, timelimit):
+                    yield row
+            return
+        except ClientError as e:
+            if started:
+                raise
+            print(f'WARNING: S3 Select is unavailable ({e}). Streaming the whole table instead.')
+    response = client.get_object(Bucket=bucket, Key=key)
+    lines = (line.decode('utf-8') for line in response['Body'].iter_lines())
+    for row in csv.DictReader(lines):
+        if is_newer(row, timelimit):
+            yield row
+
+# Function for checking that a row has an integer timestamp newer than timelimit (other rows are skipped)
+def is_newer(row, timelimit):
+    try:
+        return int(row['timestamp']) > timelimit
+    except (TypeError, ValueError):
+        print(f'WARNING: Skipping {row}')
+        return False
+
+# Function for selecting the rows of the FASTQ table that are newer than timelimit with S3 Select
+## Timestamps are compared as text (longer, or as long and greater) because a CAST fails on rows that are not integers
+## The rows are checked again with is_newer, so the results are the same as streaming the table
+def select_new_fastqs(client, bucket, key, timelimit):
+    columns = ['id', 'file', 'timestamp', 'current']
+    digits = len(str(timelimit))
+    response = client.select_object_content(
+        Bucket=bucket,
+        Key=key,
+        ExpressionType='SQL',
+        Expression=f'''SELECT s."id", s."file", s."timestamp", s."current" FROM S3Object s
+                       WHERE CHAR_LENGTH(s."timestamp") > {digits} OR (CHAR_LENGTH(s."timestamp") = {digits} AND s."timestamp" > '{timelimit}')''',
+        InputSerialization={'CSV': {'FileHeaderInfo': 'USE', 'AllowQuotedRecordDelimiter': True}},
+        OutputSerialization={'CSV': {}}
+    )
+    # records can be split across events, so only complete lines are parsed
+    remainder = ''
+    for event in response['Payload']:
+        if 'Records' in event:
+            text = remainder + event['Records']['Payload'].decode('utf-8')
+            lines = text.split('\n')
+            remainder = lines.pop()
+            for values in csv.reader(lines):
+                yield dict(zip(columns, values))
+    if remainder:
+        for values in csv.reader([remainder]):
+            yield dict(zip(columns, values))
+
+# Function for listing every file in the destination bucket (paginated)
+def list_destination(client, bucket):
+    inventory = set()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        inventory.update(obj['Key'] for obj in page.get('Contents', []))
+    return inventory
+
+# Function for reading the destination inventory manifest
+## The first line records when the destination was last listed in full (the manifest itself is rewritten as files are transferred)
+## Returns the keys and the listing time, or None if the manifest does not exist or the listing is older than max_age days (the destination is then listed again)
+def read_inventory(client, bucket, key, max_age):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return None
+    lines = gzip.decompress(response['Body'].read()).decode('utf-8').split('\n')
+    listed = int(lines[0].split('\t')[1])
+    if time.time() - listed > max_age*24*60*60:
+        return None
+    return set(lines[1:]) - {''}, listed
+
+# Function for saving the destination inventory manifest (listing time, then the sorted keys, gzipped)
+def write_inventory(client, bucket, key, inventory, listed):
+    body = gzip.compress("\n".join([f'#listed\t{listed}'] + sorted(inventory)).encode('utf-8'))
+    client.put_object(Bucket=bucket, Key=key, Body=body)
+
+# Function for reading the watermark (timestamp of the newest FASTQ file that has been transferred)
+def read_watermark(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())['watermark']
+
+# Function for saving the watermark
+def write_watermark(client, bucket, key, watermark):
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps({'watermark': watermark, 'updated': int(time.time())}))
+
+# Function for moving the watermark forward
+## The watermark only passes a file once it is in the destination, so files that failed or are pending are selected again
+def next_watermark(candidates, unfinished, watermark):
+    timestamps = [int(row[2]) for row in candidates if row[0] in unfinished]
+    if timestamps:
+        new = min(timestamps) - 1
+    else:
+        new = max([int(row[2]) for row in candidates], default=0)
+    return max(watermark or 0, new)
+
+# Function for reading a true/false option (secrets and events can hold "false" as a string)
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', 'yes', '1']
+    return bool(value)
+
+# Function for calling func with retries and exponential backoff
+## Client errors other than throttling (e.g., a missing source file) are not retried
+def with_retries(func, attempts=5, base_delay=1):
+    for attempt in range(attempts):
+        try:
+            return func()
+        except (ClientError, ConnectionError, HTTPClientError) as e:
+            if isinstance(e, ClientError):
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+                if status < 500 and e.response['Error']['Code'] not in ['SlowDown', 'Throttling', 'RequestTimeout']:
+                    raise
+            if attempt == attempts - 1:
+                raise
+            delay = base_delay * 2**attempt + random.uniform(0, 1)
+            print(f'WARNING: {e}. Retrying in {delay:.1f} seconds.')
+            time.sleep(delay)
+
+# Function for copying files to the destination bucket concurrently
+## Files larger than part_size are copied server-side in parts (UploadPartCopy), so objects over 5 GB are supported
+## transfers = list of [destination key, source path, timestamp]
+## should_stop = function that returns True when no more copies should be started (e.g., the Lambda is about to time out)
+## on_copied = function called with the destination key after each copy finishes (e.g., to save progress)
+## Returns the destination keys that were copied and the ones that failed, and the transfers that were not started
+def transfer_files(client, transfers, sourceBucket, destBucket, concurrency=8, part_size=256*1024*1024, should_stop=lambda: False, on_copied=lambda name: None):
+    config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=PART_CONCURRENCY)
+    progress = {'files': 0, 'bytes': 0}
+    lock = threading.Lock()
+    def copy_file(row):
+        copy_source = {'Bucket': sourceBucket, 'Key': row[1].replace(f's3://{sourceBucket}/', '')}
+        def attempt():
+            # bytes of a failed attempt are taken back out, so retried copies are only counted once
+            counted = [0]
+            def add_bytes(n):
+                with lock:
+                    counted[0] += n
+                    progress['bytes'] += n
+            try:
+                client.copy(copy_source, destBucket, row[0], Config=config, Callback=add_bytes)
+            except Exception:
+                with lock:
+                    progress['bytes'] -= counted[0]
+                raise
+        with_retries(attempt)
+        return row[0]
+
+    copied = []
+    failed = []
+    queue = list(transfers)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # keep up to 'concurrency' copies running, starting a new one as each finishes
+        futures = {}
+        while queue or futures:
+            while queue and len(futures) < concurrency and not should_stop():
+                row = queue.pop(0)
+                futures[executor.submit(copy_file, row)] = row[0]
+            if not futures:
+                break
+            future = next(as_completed(futures))
+            name = futures.pop(future)
+            try:
+                copied.append(future.result())
+                on_copied(name)
+            except Exception as e:
+                print(f'ERROR: Unable to transfer {name}: {e}')
+                failed.append(name)
+            with lock:
+                progress['files'] += 1
+                print(f"Progress: {progress['files']}/{len(transfers)} files, {progress['bytes']} bytes, {time.time() - start:.1f} seconds")
+    return copied, failed, queue
+
+# Functions for saving, reading and removing the queue of transfers that are still pending
+def write_queue(client, bucket, key, pending):
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps({'pending': pending, 'updated': int(time.time())}))
+
+def read_queue(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return []
+    return json.loads(response['Body'].read())['pending']
+
+def delete_queue(client, bucket, key):
+    client.delete_object(Bucket=bucket, Key=key)
 
 #-----HANDLER FUNCTION-----#
 def handler(event, contxext):
     # Initialize boto3 session and clients
     session = boto3.Session()
     secrets = session.client('secretsmanager')
-    s3      = session.client('s3')
 
     # Get secrets
     ## Define secret name
@@ -29,32 +237,118 @@ def handler(event, contxext):
     secret = json.loads(get_secret_value_response['SecretString'])
     sourceBucket = secret["sourceBucket"]
     destBucket   = secret["destBucket"]
+    useSelect    = parse_bool(secret.get("useSelect", False)) # filter the FASTQ table with S3 Select
+    inventoryMaxAge = int(secret.get("inventoryMaxAge", 7)) # days before the destination is listed again
+    concurrency  = int(secret.get("concurrency", 8)) # files copied at the same time
+    partSize     = int(secret.get("partSizeMB", 256))*1024*1024 # files larger than this are copied in parts
+    safetyTime   = int(secret.get("safetySeconds", 120))*1000 # stop starting copies when less than this much time remains
+    rescanDays   = int(secret.get("rescanDays", 30)) # window re-checked by a safety re-scan (and by the first run)
+    lookbackDays = float(secret.get("lookbackDays", 3)) # files this much older than the watermark are checked again (timestamps are the source file times, not when the row was added)
+    checkpointFiles   = int(secret.get("checkpointFiles", 50)) # progress is saved after this many copies ...
+    checkpointSeconds = int(secret.get("checkpointSeconds", 30)) # ... or this many seconds, whichever comes first
+    rescan       = parse_bool(event.get("rescan", secret.get("rescan", False))) if isinstance(event, dict) else False # re-check the whole window instead of only files newer than the watermark
+
+    ## S3 client with a connection for every part that can be copied at the same time (files x parts)
+    s3 = session.client('s3', config=Config(max_pool_connections=max(10, concurrency*PART_CONCURRENCY)))
 
     # Other variables
-    metaKey  = f'tables/meta.fastq.csv'
-
-    # New FASTQ files
-    timelimit = int(time.time()) - 30*24*60*60 # first number is days
-    response = s3.get_object(Bucket=sourceBucket, Key=metaKey)
-    content = list(csv.reader(response['Body'].read().decode('utf-8').splitlines()))
-    newFiles = []
-    for row in content:
-        try:
-            if ('_R1' in row[3] or 'R2' in row[3]) and int(row[4]) > timelimit:
-                newFiles.append([ f'{row[0]}_{"R1" if "R1" in row[3] else "R2" }.fastq.gz', row[6] ])      
-        except:
-            print(f'WARNING: Skipping {row}')
+    metaKey      = f'tables/meta.fastq.csv'
+    inventoryKey = f'cache/fq2ncbi/{destBucket}.inventory.txt.gz'
+    queueKey     = f'cache/fq2ncbi/{destBucket}.queue.json'
+    watermarkKey = f'cache/fq2ncbi/{destBucket}.watermark.json'
 
     # Files in desintaion bucket
-    response = s3.list_objects_v2(Bucket=destBucket)
-    destFiles = [obj['Key'] for obj in response.get('Contents', [])]
+    ## Read from the inventory manifest, or listed (and saved to the manifest) if it is missing or stale
+    inventory = read_inventory(s3, sourceBucket, inventoryKey, inventoryMaxAge)
+    if inventory is None:
+        print(f'Listing {destBucket}')
+        listed = int(time.time())
+        destFiles = list_destination(s3, destBucket)
+        write_inventory(s3, sourceBucket, inventoryKey, destFiles, listed)
+    else:
+        destFiles, listed = inventory
+    print(f'{len(destFiles)} files in {destBucket}')
+
+    # Continue the transfers left by a previous invocation, otherwise find the new FASTQ files
+    watermark = read_watermark(s3, sourceBucket, watermarkKey)
+    savedWatermark = watermark
+    newFiles = [row for row in read_queue(s3, sourceBucket, queueKey) if row[0] not in destFiles]
+    transferList = newFiles
+    if transferList:
+        print(f'Resuming {len(transferList)} pending transfers')
+    else:
+        # New FASTQ files
+        ## Only files newer than the watermark (less the lookback), unless this is the first run or a safety re-scan
+        ## Files that are already in the destination are skipped by the inventory
+        window = int(time.time()) - rescanDays*24*60*60
+        if watermark is None:
+            timelimit = window
+            watermark = window
+        elif rescan:
+            timelimit = min(watermark, window)
+        else:
+            timelimit = watermark - int(lookbackDays*24*60*60)
+        print(f'Checking FASTQ files newer than {timelimit}{" (re-scan)" if rescan else ""}')
+        newFiles = []
+        for row in read_new_fastqs(s3, sourceBucket, metaKey, timelimit, useSelect):
+            if '_R1' in row['file'] or 'R2' in row['file']:
+                newFiles.append([ f'{row["id"]}_{"R1" if "R1" in row["file"] else "R2" }.fastq.gz', row['current'], row['timestamp'] ])
 
-    # noTransferList = [row[0] for row in newFiles if row[0] in destFiles]
-    # print(f'These files have already been transferred: {"".join(noTransferList)}')
-    transferList = [row for row in newFiles if row[0] not in destFiles]
+        # noTransferList = [row[0] for row in newFiles if row[0] in destFiles]
+        # print(f'These files have already been transferred: {"".join(noTransferList)}')
+        transferList = [row for row in newFiles if row[0] not in destFiles]
     print(f'Transfering these files: {" ".join([ row[0] for row in transferList ])}')
-    for row in transferList:
-        copy_source = {'Bucket': sourceBucket, 'Key': row[1].replace(f's3://{sourceBucket}/', '')}
-        s3.copy_object(CopySource=copy_source, Bucket=destBucket, Key=row[0])
+
+    # Save the transfers to the queue before they start, so they are continued even if the Lambda times out during a copy
+    if transferList:
+        write_queue(s3, sourceBucket, queueKey, transferList)
+    remaining = {row[0]: row for row in transferList}
+
+    # Add the transferred files to the manifest and remove them from the queue in batches
+    ## Progress is saved every checkpointFiles copies or checkpointSeconds, when no more copies are started and at the end
+    progress = {'unsaved': 0, 'saved': time.time(), 'stopped': False}
+    def checkpoint():
+        if progress['unsaved']:
+            write_inventory(s3, sourceBucket, inventoryKey, destFiles, listed)
+            write_queue(s3, sourceBucket, queueKey, list(remaining.values()))
+        progress.update({'unsaved': 0, 'saved': time.time()})
+    def save_progress(name):
+        destFiles.add(name)
+        remaining.pop(name, None)
+        progress['unsaved'] += 1
+        if progress['unsaved'] >= checkpointFiles or time.time() - progress['saved'] >= checkpointSeconds:
+            checkpoint()
+
+    # Stop starting new copies shortly before the Lambda times out
+    def should_stop():
+        stop = contxext is not None and contxext.get_remaining_time_in_millis() < safetyTime
+        if stop and not progress['stopped']:
+            progress['stopped'] = True
+            checkpoint()
+        return stop
+    copied, failed, pending = transfer_files(s3, transferList, sourceBucket, destBucket, concurrency, partSize, should_stop, save_progress)
+    checkpoint()
+
+    # Save the pending transfers and continue them in a new invocation
+    ## Only if this invocation copied something, otherwise a new invocation would not get further (e.g., too little time was left to start a copy)
+    if pending:
+        write_queue(s3, sourceBucket, queueKey, pending)
+        if copied:
+            print(f'{len(pending)} transfers are pending. Continuing in a new invocation.')
+            try:
+                session.client('lambda').invoke(FunctionName=contxext.function_name, InvocationType='Event', Payload=json.dumps({'continuation': True}))
+            except ClientError as e:
+                print(f'WARNING: Unable to invoke {contxext.function_name} ({e}). The pending transfers will be continued by the next run.')
+        else:
+            print(f'WARNING: {len(pending)} transfers are pending and none could be completed. They will be continued by the next run.')
+    elif transferList:
+        delete_queue(s3, sourceBucket, queueKey)
+
+    # Move the watermark past the files that are now in the destination
+    newWatermark = next_watermark(newFiles, set(failed) | {row[0] for row in pending}, watermark)
+    if newWatermark != savedWatermark:
+        write_watermark(s3, sourceBucket, watermarkKey, newWatermark)
+    if failed:
+        raise RuntimeError(f'{len(failed)} files could not be transferred: {" ".join(failed)}')
 
 # handler("blah","blah")
@@ -110,11 +110,16 @@ workflow {
 =============================================================================================================================
 */
 // Function for extracting string patterns
-def extractId(id, pattern){
-    // Check if the string matches the pattern 
-    def matcher = id =~ pattern
-    // If a match is found, return the matched pattern, otherwise return the string 
-    return matcher.find() ? matcher.group() : id
+// Patterns are checked in priority order (the first pattern that matches is used), as in extract_ids.py --priority first
+def extractId(id, patterns){
+    for(pattern in patterns){
+        // Check if the string matches the pattern 
+        def matcher = id =~ pattern
+        // If a match is found, return the matched pattern
+        if(matcher.find()){ return matcher.group() }
+    }
+    // Otherwise return the string 
+    return id
 }
 
 // Function for identifying and formatting general bacterial analysis results from various sources (PHoeNIx, Theiaprok, RECAPP)
@@ -145,8 +150,7 @@ def formatResults(row){
                                  results[key] = row[col[0]] ? row[col[0]].replaceAll(',',';').replaceAll(' ','_') : null  }
 
     results.id = results.id.replaceAll(/-WA.*/, '')
-    results.id =  extractId(results.id, /WA\d{7}/) 
-    results.id = extractId(results.id, /\d{4}JQ-\d{5}/)
+    results.id = extractId(results.id, [ /WA\d{7}/, /\d{4}JQ-\d{5}/ ])
 
     return results
 }
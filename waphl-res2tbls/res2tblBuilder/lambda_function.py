@@ -2,8 +2,23 @@
 Creates table summaries of the WAPHL-Results SQL database using Athena.
 """
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import time
 import json
+import csv
+import os
+import local_builder
+
+# Transfer settings shared by all table copies
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64*1024*1024, max_concurrency=10)
+
+# Size limits of the parts of a server-side append (S3 parts other than the last must be 5 MB to 5 GB)
+MIN_PART_SIZE = 5*1024*1024
+APPEND_PART_SIZE = 1024*1024*1024
 
 #----- CREATE THE SQL DATABASE (AWS GLUE CRAWLER) -----#
 # Function to start a Glue crawler and wait for it to finish
@@ -24,103 +39,285 @@ def run_crawler(client,crawler_name):
         else:
             time.sleep(10)  # Wait for 10 seconds before checking the state again
 
+# Function for registering the partitions of new files directly with the Glue API
+## Only the partitions listed in the 'current' column of the new meta files are added, instead of crawling the whole data tree
+def register_partitions(glue, s3, database, table, meta_files):
+    # Get the partition keys and storage format of the table
+    table_info = glue.get_table(DatabaseName=database, Name=table)['Table']
+    keys = [k['Name'] for k in table_info['PartitionKeys']]
+    sd = table_info['StorageDescriptor']
+
+    # Get the partitions of each file in the new meta files
+    partitions = {}
+    for path in meta_files:
+        meta_bucket, meta_key = path.replace('s3://', '').split('/', 1)
+        lines = s3.get_object(Bucket=meta_bucket, Key=meta_key)['Body'].iter_lines()
+        for row in csv.DictReader(line.decode('utf-8') for line in lines):
+            location = row['current'].rsplit('/', 1)[0] + '/'
+            values = dict(p.split('=', 1) for p in location.split('/') if '=' in p)
+            if all(k in values for k in keys):
+                partitions[location] = [values[k] for k in keys]
+    print(f"Registering {len(partitions)} partitions of '{table}' from {len(meta_files)} meta files.")
+
+    # Register the partitions (Glue accepts up to 100 per request)
+    partition_list = [{'Values': values, 'StorageDescriptor': dict(sd, Location=location)} for location, values in partitions.items()]
+    for i in range(0, len(partition_list), 100):
+        response = glue.batch_create_partition(DatabaseName=database, TableName=table, PartitionInputList=partition_list[i:i+100])
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException':
+                raise RuntimeError(f"Unable to register partition {error['PartitionValues']}: {error['ErrorDetail']['ErrorMessage']}")
+
 #----- TABLES REQUIRING AWS ATHENA -----#
+# Columns of the cleaned metadata table (meta_alt)
+META_ALT_COLUMNS = """
+    id,
+    CASE
+        WHEN LOWER(workflow) LIKE '%phoenix%' THEN 'phoenix'
+        WHEN LOWER(workflow) LIKE '%theiaprok%' THEN 'theiaprok'
+        WHEN UPPER(workflow) LIKE '%RECAPP%' THEN 'recapp'
+        WHEN UPPER(workflow) LIKE '%BASESPACE%' THEN 'basespace_fetch'
+        ELSE workflow
+    END AS workflow,
+    run,
+    file,
+    timestamp,
+    origin,
+    current,
+    REGEXP_REPLACE(id, '-WA.*', '') AS id_alt
+    """
+
+# Function for selecting the rows of the new meta files that are not already in meta_alt
+## Returns the FROM/WHERE part of a query (the rows are named 'delta')
+def delta_rows(delta):
+    paths = ", ".join([f"'{path}'" for path in delta])
+    return f"""
+        (SELECT DISTINCT {META_ALT_COLUMNS} FROM meta WHERE "$path" IN ({paths})) AS delta
+        WHERE NOT EXISTS (SELECT 1 FROM meta_alt WHERE meta_alt.current = delta.current)
+        """
+
+# Function for getting the queries that update meta_alt
+## meta_alt is stored in {key}/meta_alt/ (outside of tmp/, which is removed after every build) so incremental builds can compare against it
+## delta = None rebuilds meta_alt from scratch (clear_meta_alt must be called first), otherwise the rows of the new meta files are added to it
+def meta_alt_queries(bucket, key, delta=None):
+    if delta is None:
+        return ["DROP TABLE IF EXISTS meta_alt;",
+                f"CREATE TABLE meta_alt WITH (external_location = 's3://{bucket}/{key}/meta_alt/') AS SELECT DISTINCT {META_ALT_COLUMNS} FROM meta;"]
+    return [f"INSERT INTO meta_alt SELECT * FROM {delta_rows(delta)};"]
+
+# Function for removing the data of meta_alt before it is rebuilt (Athena requires the location of a new table to be empty)
+def clear_meta_alt(s3, bucket, key):
+    return delete_directory(s3, bucket, f'{key}/meta_alt/')
+
+# Function for checking whether meta_alt has data (incremental builds compare against it)
+def meta_alt_exists(s3, bucket, key):
+    return s3.list_objects_v2(Bucket=bucket, Prefix=f'{key}/meta_alt/', MaxKeys=1)['KeyCount'] > 0
+
+# Conditions used to create each table from meta_alt (None = all rows)
+TABLE_FILTERS = {
+    's3': None,
+    's4': """
+            (id = 'null' AND workflow = 'phoenix' AND file = 'Phoenix_Summary.tsv') OR 
+            (id = 'null' AND workflow = 'phoenix' AND file = 'terra_table.tsv' ) OR
+            (id = 'null' AND workflow = 'theiaprok' AND file = 'terra_table.tsv') OR
+            (id = 'null' AND workflow = 'recapp' AND file = 'terra_table.tsv')
+        """,
+    's5': """
+            file LIKE '%.fastq.gz%' AND
+            (file LIKE '%R1%' OR file LIKE '%R2%')
+        """,
+    's6': """
+            file LIKE '%.fasta%' 
+            OR file LIKE '%.fa' 
+            OR file LIKE '%.fa.gz' 
+            OR file LIKE '%.fna%'
+        """
+}
+
+# Table created by each processing step
+TABLE_NAMES = {
+    's2': 'meta.raw.csv',
+    's3': 'meta.clean.csv',
+    's4': 'meta.gba.csv',
+    's5': 'meta.fastq.csv',
+    's6': 'meta.fasta.csv'
+}
+
+# Column order of each table when written as Parquet (the partition column must be last)
+PARQUET_COLUMNS = {
+    's2': 'id, run, file, timestamp, origin, current, workflow',
+    's3': 'id, run, file, timestamp, origin, current, id_alt, workflow',
+    's4': 'id, run, file, timestamp, origin, current, id_alt, workflow',
+    's5': 'id, run, file, timestamp, origin, current, id_alt, workflow',
+    's6': 'id, run, file, timestamp, origin, current, id_alt, workflow'
+}
+
 # Function for creating tables via Athena
-def create_table_athena(athena, s3, database, tmpdir, bucket, key):
+## delta = None rebuilds meta_alt and all tables from scratch
+## delta = [list of meta file paths] only adds the rows from those files to meta_alt and the existing tables
+## formats = table formats to write: 'csv' ({key}/meta.*.csv) and/or 'parquet' ({key}/meta.*/workflow=*/)
+## report = dictionary that query statistics ('queries') and S3 summaries ('s3') are added to
+def create_table_athena(athena, s3, database, tmpdir, bucket, key, max_queries=5, delta=None, formats=('csv',), report=None):
+    report = report if report is not None else {'queries': [], 's3': []}
     # Define data processing steps
-    procc = {
-        's1': {'database': database,
-               'outdir': tmpdir,
-               'queries': [ 
-                   """
-                   DROP TABLE IF EXISTS meta_alt;
-                   """,
-                   """
-                   CREATE TABLE meta_alt AS
-                   SELECT DISTINCT
-                   id,
-                   CASE
-                       WHEN LOWER(workflow) LIKE '%phoenix%' THEN 'phoenix'
-                       WHEN LOWER(workflow) LIKE '%theiaprok%' THEN 'theiaprok'
-                       WHEN UPPER(workflow) LIKE '%RECAPP%' THEN 'recapp'
-                       WHEN UPPER(workflow) LIKE '%BASESPACE%' THEN 'basespace_fetch'
-                       ELSE workflow
-                   END AS workflow,
-                   run,
-                   file,
-                   timestamp,
-                   origin,
-                   current,
-                   REGEXP_REPLACE(id, '-WA.*', '') AS id_alt
-                   FROM meta;
-                   """] },
-        's2': {'database': database,
-               'outdir': tmpdir,
-               'queries': ["SELECT * FROM meta;"] },
-        's3': {'database': database,
-               'outdir': tmpdir,
-               'queries': ["SELECT * FROM meta_alt;"] },
-        's4': {'database': database,
-               'outdir': tmpdir,
-               'queries': ["""
-                    SELECT * FROM meta_alt 
-                    WHERE
-                        (id = 'null' AND workflow = 'phoenix' AND file = 'Phoenix_Summary.tsv') OR 
-                        (id = 'null' AND workflow = 'phoenix' AND file = 'terra_table.tsv' ) OR
-                        (id = 'null' AND workflow = 'theiaprok' AND file = 'terra_table.tsv') OR
-                        (id = 'null' AND workflow = 'recapp' AND file = 'terra_table.tsv');
-                    """] },
-        's5': {'database': database,
-               'outdir': tmpdir,
-               'queries': ["""
-                    SELECT * FROM meta_alt 
-                    WHERE 
-                        file LIKE '%.fastq.gz%' AND
-                        (file LIKE '%R1%' OR file LIKE '%R2%');
-                    """] },
-        's6': {'database': database,
-               'outdir': tmpdir,
-               'queries': ["""
-                    SELECT * FROM meta_alt 
-                    WHERE 
-                        file LIKE '%.fasta%' 
-                        OR file LIKE '%.fa' 
-                        OR file LIKE '%.fa.gz' 
-                        OR file LIKE '%.fna%';
-                    """] }
-    }
+    ## 'depends' lists the steps that must finish before a step can start
+    if delta is None:
+        procc = {
+            's1': {'database': database,
+                   'outdir': tmpdir,
+                   'depends': [],
+                   'queries': meta_alt_queries(bucket, key) },
+            's2': {'database': database,
+                   'outdir': tmpdir,
+                   'depends': [],
+                   'queries': ["SELECT * FROM meta;"] }
+        }
+        for step in TABLE_FILTERS:
+            procc[step] = {'database': database,
+                           'outdir': tmpdir,
+                           'depends': ['s1'],
+                           'queries': [f"SELECT * FROM meta_alt {f'WHERE {TABLE_FILTERS[step]}' if TABLE_FILTERS[step] else ''};"] }
+    else:
+        # Rows from the new meta files that are not already in meta_alt
+        ## The tables are selected before meta_alt is updated, so they all see the same delta
+        paths = ", ".join([f"'{path}'" for path in delta])
+        new_rows = delta_rows(delta)
+        procc = {
+            's2': {'database': database,
+                   'outdir': tmpdir,
+                   'depends': [],
+                   'queries': [f"""
+                       SELECT * FROM meta WHERE "$path" IN ({paths})
+                       AND NOT EXISTS (SELECT 1 FROM meta_alt WHERE meta_alt.current = meta.current);
+                       """] }
+        }
+        for step in TABLE_FILTERS:
+            procc[step] = {'database': database,
+                           'outdir': tmpdir,
+                           'depends': [],
+                           'queries': [f"SELECT * FROM {new_rows} {f'AND ({TABLE_FILTERS[step]})' if TABLE_FILTERS[step] else ''};"] }
+
+    # Add a Parquet export (partitioned by workflow) of each table
+    ## Athena requires the UNLOAD location to be empty
+    if 'parquet' in formats:
+        delete_directory(s3, bucket, f'{key}/tmp')
+        for step in TABLE_NAMES:
+            select = procc[step]['queries'][-1].strip().rstrip(';')
+            procc[f'{step}p'] = {'database': database,
+                                 'outdir': tmpdir,
+                                 'depends': procc[step]['depends'],
+                                 'queries': [f"""
+                                     UNLOAD (SELECT {PARQUET_COLUMNS[step]} FROM ({select}))
+                                     TO '{tmpdir}/{parquet_name(step)}/'
+                                     WITH (format = 'PARQUET', compression = 'SNAPPY', partitioned_by = ARRAY['workflow']);
+                                     """] }
+    if 'csv' not in formats:
+        for step in TABLE_NAMES:
+            del procc[step]
+
+    # meta_alt is only updated once all of the incremental tables have been selected
+    if delta is not None:
+        procc['s1'] = {'database': database,
+                       'outdir': tmpdir,
+                       'depends': list(procc),
+                       'queries': meta_alt_queries(bucket, key, delta) }
 
     # Run processing steps
-    ## empty dictionary for capturing metadata for each processing step
-    qids = {}
-    for step in procc:
-        print(f'Starting {step}')
-        db      = procc[step]["database"]
-        outdir  = procc[step]["outdir"]
-        queries = procc[step]["queries"]
-        print(f'  Database: {db}\n  Outdir: {outdir}\n  Queries: {len(queries)}')
-        
-        qcount=0
-        meta = {}
-        for q in queries:
-            q = " ".join(q.split())
-            print(f'\n  {q}\n')
-            response = run_query(athena, q, db, outdir)
-            waitForQuery(athena, response['QueryExecutionId'])
-            meta[qcount] = [q, db, outdir, response['QueryExecutionId']]
-            qcount = qcount + 1
-        qids[step] = meta
-
-    # Rename tables
-    rename_table(s3, bucket, f'{key}/tmp/{qids["s2"][0][3]}.csv', f'{key}/meta.raw.csv')
-    rename_table(s3, bucket, f'{key}/tmp/{qids["s3"][0][3]}.csv', f'{key}/meta.clean.csv')
-    rename_table(s3, bucket, f'{key}/tmp/{qids["s4"][0][3]}.csv', f'{key}/meta.gba.csv')
-    rename_table(s3, bucket, f'{key}/tmp/{qids["s5"][0][3]}.csv', f'{key}/meta.fastq.csv')
-    rename_table(s3, bucket, f'{key}/tmp/{qids["s6"][0][3]}.csv', f'{key}/meta.fasta.csv')
+    if delta is None:
+        report['s3'].append(clear_meta_alt(s3, bucket, key))
+    qids = run_steps(athena, procc, max_queries, report['queries'])
+
+    # Rename (full) or append to (incremental) tables
+    ## Each table is moved into place concurrently
+    def publish(step):
+        summaries = []
+        if 'csv' in formats:
+            source_key = f'{key}/tmp/{qids[step][0][3]}.csv'
+            dest_key   = f'{key}/{TABLE_NAMES[step]}'
+            if delta is None:
+                summaries.append(rename_table(s3, bucket, source_key, dest_key))
+            else:
+                summaries.append(append_table(s3, bucket, source_key, dest_key))
+        if 'parquet' in formats:
+            summaries.append(move_parquet(s3, bucket, f'{key}/tmp/{parquet_name(step)}/', f'{key}/{parquet_name(step)}/', replace=delta is None))
+        return summaries
+    with ThreadPoolExecutor(max_workers=len(TABLE_NAMES)) as executor:
+        report['s3'].extend([summary for result in executor.map(publish, TABLE_NAMES) for summary in result])
 
     # Clean up unwanted files
-    delete_directory(s3, bucket, f'{key}/tmp')
+    report['s3'].append(delete_directory(s3, bucket, f'{key}/tmp'))
+    return report
+
+# Function for getting the name of the Parquet version of a table (e.g., 'meta.clean')
+def parquet_name(step):
+    return TABLE_NAMES[step].replace('.csv', '')
+
+# Function for listing the meta files
+def list_meta(client, bucket, prefix):
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend([obj for obj in page.get('Contents', []) if obj['Key'].endswith('.csv')])
+    return objects
+
+# Function for selecting the meta files that were added after the watermark
+## LastModified has a resolution of one second (and is the start of an upload), so files modified up to 'overlap' seconds
+## before the watermark are selected again. Their rows are already in meta_alt and are skipped by 'current'.
+## Returns the S3 paths of the new files and the new watermark (most recent LastModified, unix time)
+def new_meta(objects, bucket, watermark, overlap=0):
+    new_files = []
+    new_watermark = watermark
+    for obj in objects:
+        modified = obj['LastModified'].timestamp()
+        if modified > watermark - overlap:
+            new_files.append(f's3://{bucket}/{obj["Key"]}')
+            new_watermark = max(new_watermark, modified)
+    return new_files, new_watermark
+
+# Function for creating a fingerprint of the meta files (key, ETag and size of each file)
+def fingerprint_meta(objects):
+    listing = sorted(f"{obj['Key']},{obj['ETag']},{obj['Size']}" for obj in objects)
+    return hashlib.sha256("\n".join(listing).encode('utf-8')).hexdigest()
+
+# Function for reading a true/false option (secrets and events can hold "false" as a string)
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', 'yes', '1']
+    return bool(value)
+
+# Function for getting the names of the tables written for each format
+def table_outputs(formats):
+    outputs = []
+    if 'csv' in formats:
+        outputs.extend(TABLE_NAMES.values())
+    if 'parquet' in formats:
+        outputs.extend([f'{parquet_name(step)}/' for step in TABLE_NAMES])
+    return outputs
+
+# Function for reading the fingerprint of the inputs used to build each table
+def read_fingerprints(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=f'{key}/fingerprint.json')
+    except client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(response['Body'].read())['tables']
+
+# Function for saving the fingerprint of the inputs used to build each table
+def write_fingerprints(client, bucket, key, fingerprints):
+    body = json.dumps({'tables': fingerprints, 'updated': int(time.time())}, indent=2)
+    client.put_object(Bucket=bucket, Key=f'{key}/fingerprint.json', Body=body)
+
+# Function for reading the meta_alt watermark (returns None if meta_alt has not been built)
+def read_watermark(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=f'{key}/meta_alt.watermark.json')
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())['watermark']
 
+# Function for saving the meta_alt watermark
+def write_watermark(client, bucket, key, watermark, mode, n_files):
+    body = json.dumps({'watermark': watermark, 'mode': mode, 'files': n_files, 'updated': int(time.time())})
+    client.put_object(Bucket=bucket, Key=f'{key}/meta_alt.watermark.json', Body=body)
 
 # Function to run an Athena query
 def run_query(client, query, db, output):
@@ -132,45 +329,290 @@ def run_query(client, query, db, output):
     )
     return response
 
-# Function to wait for query completion
-def waitForQuery(client, query_execution_id):
+# Function to run processing steps as a dependency graph
+## Steps whose dependencies have finished are submitted together (up to max_queries at once).
+## Queries within a step are run in order.
+## Statistics for each query are added to query_stats. A failed query stops all steps.
+def run_steps(client, procc, max_queries=5, query_stats=None):
+    ## empty dictionary for capturing metadata for each processing step
+    qids    = {step: {} for step in procc}
+    pending = {step: list(procc[step]['queries']) for step in procc}
+    running = {} # query execution ID -> step
+    done    = set()
+    while len(done) < len(procc):
+        # Submit the next query of each step that is ready
+        for step in procc:
+            if len(running) >= max_queries:
+                break
+            if step in done or step in running.values():
+                continue
+            if not all(d in done for d in procc[step]['depends']):
+                continue
+            db     = procc[step]["database"]
+            outdir = procc[step]["outdir"]
+            if not qids[step]:
+                print(f'Starting {step}')
+                print(f'  Database: {db}\n  Outdir: {outdir}\n  Queries: {len(procc[step]["queries"])}')
+            q = " ".join(pending[step].pop(0).split())
+            print(f'\n  {step}: {q}\n')
+            response = run_query(client, q, db, outdir)
+            qids[step][len(qids[step])] = [q, db, outdir, response['QueryExecutionId']]
+            running[response['QueryExecutionId']] = step
+
+        # Wait for at least one running query to finish
+        if not running:
+            raise RuntimeError(f'Unable to schedule steps: {[step for step in procc if step not in done]}')
+        finished = waitForQueries(client, list(running))
+        for execution in finished:
+            qid  = execution['QueryExecutionId']
+            step = running.pop(qid)
+            stats = query_statistics(step, execution)
+            log_query_metrics(stats)
+            if query_stats is not None:
+                query_stats.append(stats)
+            if stats['state'] != 'SUCCEEDED':
+                for other in running:
+                    client.stop_query_execution(QueryExecutionId=other)
+                raise RuntimeError(f"{step} query {qid} {stats['state']}: {stats['reason']}")
+            if not pending[step]:
+                print(f'Finished {step}')
+                done.add(step)
+    return qids
+
+# Function to wait for one or more queries to complete
+## Returns the executions (as returned by get_query_execution) of the queries that have finished
+def waitForQueries(client, query_execution_ids):
     while True:
-        response = client.get_query_execution(QueryExecutionId=query_execution_id)
-        status = response['QueryExecution']['Status']['State']
-        if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            return status
+        finished = []
+        # Athena accepts up to 50 IDs per request
+        for i in range(0, len(query_execution_ids), 50):
+            response = client.batch_get_query_execution(QueryExecutionIds=query_execution_ids[i:i+50])
+            for execution in response['QueryExecutions']:
+                if execution['Status']['State'] in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+                    finished.append(execution)
+        if finished:
+            return finished
         time.sleep(2)
 
+# Function for extracting the cost and latency of a finished query
+def query_statistics(step, execution):
+    statistics = execution.get('Statistics', {})
+    return {
+        'step': step,
+        'query_execution_id': execution['QueryExecutionId'],
+        'state': execution['Status']['State'],
+        'reason': execution['Status'].get('StateChangeReason'),
+        'queue_ms': statistics.get('QueryQueueTimeInMillis', 0),
+        'engine_ms': statistics.get('EngineExecutionTimeInMillis', 0),
+        'total_ms': statistics.get('TotalExecutionTimeInMillis', 0),
+        'scanned_bytes': statistics.get('DataScannedInBytes', 0)
+    }
+
+# Function for logging query statistics in CloudWatch embedded metric format
+def log_query_metrics(stats):
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': 'waphl-res2tbl',
+                'Dimensions': [['Step']],
+                'Metrics': [
+                    {'Name': 'QueryQueueTime', 'Unit': 'Milliseconds'},
+                    {'Name': 'QueryEngineTime', 'Unit': 'Milliseconds'},
+                    {'Name': 'DataScanned', 'Unit': 'Bytes'}
+                ]
+            }]
+        },
+        'Step': stats['step'],
+        'QueryQueueTime': stats['queue_ms'],
+        'QueryEngineTime': stats['engine_ms'],
+        'DataScanned': stats['scanned_bytes'],
+        'QueryExecutionId': stats['query_execution_id'],
+        'State': stats['state']
+    }))
+
+# Function for saving the run report next to the tables
+def write_report(client, bucket, key, report):
+    client.put_object(Bucket=bucket, Key=f'{key}/res2tbl.report.json', Body=json.dumps(report, indent=2))
+
+# Function for reporting the size and duration of an S3 operation
+def summarize(operation, n_objects, n_bytes, start):
+    summary = {'operation': operation, 'objects': n_objects, 'bytes': n_bytes, 'seconds': round(time.time() - start, 2)}
+    print(f"{operation}: {n_objects} objects, {n_bytes} bytes, {summary['seconds']} seconds")
+    return summary
+
 # Function for renaming the Athena table queries
 def rename_table(client, bucket, source_key, dest_key):
+    start = time.time()
     print(f'\nRenaming {source_key} to {dest_key}')
+    size = client.head_object(Bucket=bucket, Key=source_key)['ContentLength']
     copy_source = { 'Bucket': bucket, 'Key': source_key }
-    client.copy(copy_source, bucket, dest_key)
+    client.copy(copy_source, bucket, dest_key, Config=TRANSFER_CONFIG)
+    client.delete_object(Bucket=bucket, Key=source_key)
+    return summarize(f'rename {dest_key}', 1, size, start)
+
+# Function for appending the rows of an Athena table query to an existing table
+## The table is joined with the new rows (without their header) on the server with a multipart copy, so only the new rows are transferred
+## Tables smaller than an S3 part are downloaded and appended to instead
+## Falls back to renaming if the table does not exist yet
+def append_table(client, bucket, source_key, dest_key):
+    try:
+        size = client.head_object(Bucket=bucket, Key=dest_key)['ContentLength']
+    except ClientError as e:
+        # only a missing table is replaced, other errors (e.g., access denied or throttling) must not overwrite it with the new rows
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+        return rename_table(client, bucket, source_key, dest_key)
+    start = time.time()
+    print(f'\nAppending {source_key} to {dest_key}')
+    new_size = client.head_object(Bucket=bucket, Key=source_key)['ContentLength']
+    header = client.get_object(Bucket=bucket, Key=source_key, Range='bytes=0-65535')['Body'].read().split(b'\n')[0]
+    offset = len(header) + 1
+    if new_size <= offset:
+        print(f'No new rows for {dest_key}')
+    elif size < MIN_PART_SIZE:
+        rewrite_table(client, bucket, source_key, dest_key)
+    else:
+        concat_table(client, bucket, source_key, dest_key, size, offset, new_size)
     client.delete_object(Bucket=bucket, Key=source_key)
+    return summarize(f'append {dest_key}', 1, max(new_size - offset, 0), start)
+
+# Function for appending new rows to a small table by downloading it
+def rewrite_table(client, bucket, source_key, dest_key):
+    local = f'/tmp/{os.path.basename(dest_key)}'
+    client.download_file(bucket, dest_key, local, Config=TRANSFER_CONFIG)
+    new_rows = client.get_object(Bucket=bucket, Key=source_key)['Body'].iter_lines()
+    next(new_rows, None) # skip header
+    with open(local, 'ab') as f:
+        for line in new_rows:
+            f.write(line + b'\n')
+    client.upload_file(local, bucket, dest_key, Config=TRANSFER_CONFIG)
+    os.remove(local)
+
+# Function for appending new rows to a table with a server-side multipart copy
+## The table is copied in parts of about APPEND_PART_SIZE, followed by the new rows from byte 'offset' of the source
+def concat_table(client, bucket, source_key, dest_key, size, offset, new_size):
+    n_parts = -(-size // APPEND_PART_SIZE)
+    part_size = -(-size // n_parts)
+    ranges = [(dest_key, i, min(i + part_size, size) - 1) for i in range(0, size, part_size)]
+    ranges.append((source_key, offset, new_size - 1))
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=dest_key)['UploadId']
+    try:
+        parts = []
+        for number, (part_key, first, last) in enumerate(ranges, start=1):
+            response = client.upload_part_copy(Bucket=bucket, Key=dest_key, UploadId=upload_id, PartNumber=number,
+                                               CopySource={'Bucket': bucket, 'Key': part_key}, CopySourceRange=f'bytes={first}-{last}')
+            parts.append({'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']})
+        client.complete_multipart_upload(Bucket=bucket, Key=dest_key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=dest_key, UploadId=upload_id)
+        raise
+
+# Function for moving a Parquet table written by UNLOAD into place
+## replace = True removes the previous version of the table first (full rebuild), otherwise files are added to it
+def move_parquet(client, bucket, source_prefix, dest_prefix, replace=True):
+    start = time.time()
+    print(f'\nMoving {source_prefix} to {dest_prefix}')
+    if replace:
+        delete_directory(client, bucket, dest_prefix)
+    n_objects = 0
+    n_bytes = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=source_prefix):
+        for obj in page.get('Contents', []):
+            dest_key = dest_prefix + obj['Key'][len(source_prefix):]
+            client.copy({ 'Bucket': bucket, 'Key': obj['Key'] }, bucket, dest_key, Config=TRANSFER_CONFIG)
+            n_objects += 1
+            n_bytes += obj['Size']
+    delete_directory(client, bucket, source_prefix)
+    return summarize(f'move {dest_prefix}', n_objects, n_bytes, start)
 
 # Function to delete directory in S3 bucket
+## Objects are deleted in batches of 1000 (the limit of delete_objects)
 def delete_directory(client, bucket_name, prefix):
-    # List all objects in the directory (prefix)
-    response = client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    
-    # Check if there are any objects to delete
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            # Print the file being deleted (optional)
-            print(f"Deleting {obj['Key']}")
-            
-            # Delete the object
-            client.delete_object(Bucket=bucket_name, Key=obj['Key'])
-        
-        # If there are more objects to delete, repeat the process
-        while response['IsTruncated']:
-            response = client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, ContinuationToken=response['NextContinuationToken'])
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    print(f"Deleting {obj['Key']}")
-                    client.delete_object(Bucket=bucket_name, Key=obj['Key'])
+    start = time.time()
+    n_objects = 0
+    n_bytes = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects = page.get('Contents', [])
+        if not objects:
+            continue
+        response = client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': obj['Key']} for obj in objects], 'Quiet': True}
+        )
+        for error in response.get('Errors', []):
+            print(f"WARNING: Unable to delete {error['Key']}: {error['Message']}")
+        n_objects += len(objects) - len(response.get('Errors', []))
+        n_bytes += sum(obj['Size'] for obj in objects)
     
     print(f"All objects under {prefix} have been deleted.")
+    return summarize(f'delete {prefix}', n_objects, n_bytes, start)
+
+#----- TABLES BUILT WITHOUT ATHENA -----#
+# Function for creating the tables in a single pass over the meta files (see local_builder.py)
+## delta = False rebuilds the tables from meta_files, delta = True adds the rows from meta_files to the existing tables
+## meta_alt is updated with Athena once the tables are published (rebuilt, or the new rows inserted), so later incremental builds see the same rows
+def create_table_local(athena, s3, database, tmpdir, bucket, key, meta_files, delta=False, max_queries=5, report=None):
+    report = report if report is not None else {'queries': [], 's3': []}
+    start = time.time()
+    outdir = '/tmp/res2tbl'
+    os.makedirs(outdir, exist_ok=True)
+
+    # Rows of the new meta files that are already in the tables (incremental builds)
+    ## Only the 'current' values of the new files are looked up in meta_alt
+    exclude = set()
+    if delta:
+        paths = ", ".join([f"'{path}'" for path in meta_files])
+        procc = {'x': {'database': database,
+                       'outdir': tmpdir,
+                       'depends': [],
+                       'queries': [f"""
+                           SELECT DISTINCT current FROM meta_alt
+                           WHERE current IN (SELECT current FROM meta WHERE "$path" IN ({paths}));
+                           """] }}
+        qids = run_steps(athena, procc, max_queries, report['queries'])
+        paginator = athena.get_paginator('get_query_results')
+        for page in paginator.paginate(QueryExecutionId=qids['x'][0][3]):
+            exclude.update(row['Data'][0].get('VarCharValue') for row in page['ResultSet']['Rows'])
+        exclude.discard('current') # header
+        print(f'{len(exclude)} rows of the new meta files are already in the tables.')
+
+    # Stream the meta files once, routing each row to every table
+    def read_meta():
+        for path in meta_files:
+            meta_bucket, meta_key = path.replace('s3://', '').split('/', 1)
+            lines = s3.get_object(Bucket=meta_bucket, Key=meta_key)['Body'].iter_lines()
+            yield from csv.DictReader(line.decode('utf-8') for line in lines)
+    counts = local_builder.build_tables(read_meta(), outdir, exclude)
+    report['s3'].append(summarize(f'build {len(meta_files)} meta files', sum(counts.values()), 0, start))
+
+    # Upload (full) or append to (incremental) tables
+    def publish(table):
+        start = time.time()
+        local = os.path.join(outdir, table)
+        if delta:
+            s3.upload_file(local, bucket, f'{key}/tmp/{table}', Config=TRANSFER_CONFIG)
+            summary = append_table(s3, bucket, f'{key}/tmp/{table}', f'{key}/{table}')
+        else:
+            s3.upload_file(local, bucket, f'{key}/{table}', Config=TRANSFER_CONFIG)
+            summary = summarize(f'upload {key}/{table}', 1, os.path.getsize(local), start)
+        os.remove(local)
+        return summary
+    with ThreadPoolExecutor(max_workers=len(counts)) as executor:
+        report['s3'].extend(executor.map(publish, counts))
+
+    # Update meta_alt
+    if not delta:
+        report['s3'].append(clear_meta_alt(s3, bucket, key))
+    procc = {'s1': {'database': database,
+                    'outdir': tmpdir,
+                    'depends': [],
+                    'queries': meta_alt_queries(bucket, key, meta_files if delta else None) }}
+    run_steps(athena, procc, max_queries, report['queries'])
+    report['s3'].append(delete_directory(s3, bucket, f'{key}/tmp'))
+    return report
 
 #-----TABLES REQUIRING AWS BATCH-----#
 # Function for submitting AWS Batch job
@@ -210,7 +652,7 @@ def handler(event, contxext):
     session = boto3.Session()
     secrets = session.client('secretsmanager')
     athena  = session.client('athena')
-    s3      = session.client('s3')
+    s3      = session.client('s3', config=Config(max_pool_connections=len(TABLE_NAMES)*TRANSFER_CONFIG.max_concurrency)) # every table is copied at the same time
     glue    = session.client('glue')
     batch   = session.client('batch')
 
@@ -234,16 +676,88 @@ def handler(event, contxext):
     key      = secret["key"]
     jobqueue = secret["jobqueue"]
     jobdef   = secret["jobdef"]
+    max_queries = int(secret.get("max_queries", 5)) # concurrent Athena queries (keep within the workgroup limit)
+    meta_prefix = secret.get("meta_prefix", "meta/") # location of the meta files in the bucket
+    mode        = secret.get("mode", "full") # 'full' or 'incremental'
+    max_delta   = int(secret.get("max_delta", 1000)) # incremental runs with more new meta files than this are rebuilt in full
+    formats     = secret.get("formats", "csv").split(',') # table formats to write ('csv' and/or 'parquet')
+    catalog     = secret.get("catalog", "crawler") # 'crawler' or 'partitions' (register the partitions of new files only)
+    data_table  = secret.get("data_table", "data") # Glue table of the data tree
+    engine      = secret.get("engine", "athena") # 'athena', 'local' or 'auto' (local for small incremental updates)
+    local_max   = int(secret.get("local_max", 50)) # largest number of new meta files built locally when engine = 'auto'
+    overlap     = int(secret.get("overlap_seconds", 300)) # meta files modified this long before the watermark are checked again
+    ## Allow the mode to be set by the event (e.g., a periodic full rebuild)
+    if isinstance(event, dict) and 'mode' in event:
+        mode = event['mode']
+    ## Allow the event to rebuild the tables even if the inputs have not changed
+    force = isinstance(event, dict) and parse_bool(event.get('force', False))
 
     # Other variables
     tabledir  = f's3://{bucket}/{key}'
     tmpdir    = f'{tabledir}/tmp'
     
-    # Run Glue crawler to update the Athena database
-    run_crawler(glue, crawler)
+    # Skip the rebuild if the meta files have not changed since every table was last built
+    meta_objects = list_meta(s3, bucket, meta_prefix)
+    fingerprint  = fingerprint_meta(meta_objects)
+    fingerprints = read_fingerprints(s3, bucket, key)
+    if not force and all(fingerprints.get(table) == fingerprint for table in table_outputs(formats)):
+        print(f'Meta files are unchanged since the last build (fingerprint {fingerprint}). Nothing to do.')
+        return
+
+    # Determine which meta files are new since the last build
+    watermark = read_watermark(s3, bucket, key)
+    new_files, new_watermark = new_meta(meta_objects, bucket, watermark or 0, overlap)
+    delta = None
+    if mode == 'incremental' and watermark is not None and not meta_alt_exists(s3, bucket, key):
+        print('meta_alt has no data. Rebuilding all tables.')
+    elif mode == 'incremental' and watermark is not None:
+        if not new_files:
+            print('No new meta files since the last build. Nothing to do.')
+            return
+        if len(new_files) > max_delta:
+            print(f'{len(new_files)} new meta files (max_delta = {max_delta}). Rebuilding all tables.')
+        else:
+            print(f'{len(new_files)} new meta files. Updating tables incrementally.')
+            delta = new_files
 
-    # Create tables using Athena
-    create_table_athena(athena, s3, database, tmpdir, bucket, key)
+    # Update the Athena database
+    ## Register the partitions of the new files, falling back to the Glue crawler
+    registered = False
+    if catalog == 'partitions' and watermark is not None:
+        try:
+            register_partitions(glue, s3, database, data_table, new_files)
+            registered = True
+        except Exception as e:
+            print(f'WARNING: Partition registration failed ({e}). Running the crawler instead.')
+    if not registered:
+        run_crawler(glue, crawler)
+
+    # Create tables using Athena or in a single local pass (CSV tables only)
+    ## Query statistics and S3 summaries are saved to a run report next to the tables
+    use_local = formats == ['csv'] and (engine == 'local' or (engine == 'auto' and delta is not None and len(delta) <= local_max))
+    report = {'started': int(time.time()),
+              'mode': 'full' if delta is None else 'incremental',
+              'engine': 'local' if use_local else 'athena',
+              'formats': formats,
+              'new_files': len(new_files),
+              'status': 'FAILED',
+              'queries': [],
+              's3': []}
+    try:
+        if use_local:
+            print('Building tables locally.')
+            meta_files = new_files if delta is not None else [f's3://{bucket}/{obj["Key"]}' for obj in meta_objects]
+            create_table_local(athena, s3, database, tmpdir, bucket, key, meta_files, delta is not None, max_queries, report)
+        else:
+            create_table_athena(athena, s3, database, tmpdir, bucket, key, max_queries, delta, formats, report)
+        report['status'] = 'SUCCEEDED'
+    finally:
+        report['finished']      = int(time.time())
+        report['scanned_bytes'] = sum(q['scanned_bytes'] for q in report['queries'])
+        write_report(s3, bucket, key, report)
+    write_watermark(s3, bucket, key, new_watermark, 'full' if delta is None else 'incremental', len(new_files))
+    fingerprints.update({table: fingerprint for table in table_outputs(formats)})
+    write_fingerprints(s3, bucket, key, fingerprints)
 
     # Create tables using AWS Batch
     create_table_batch(batch, jobqueue, jobdef, bucket, key)
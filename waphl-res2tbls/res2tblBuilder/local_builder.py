@@ -0,0 +1,124 @@
+"""
+Builds the res2tbl tables from the meta files in a single pass, without Athena.
+Reproduces meta_alt and the table definitions (s2-s6) in lambda_function.py.
+"""
+import argparse
+import csv
+import hashlib
+import os
+import re
+
+# Columns of the meta files and the cleaned metadata (meta_alt)
+META_COLUMNS = ['id', 'workflow', 'run', 'file', 'timestamp', 'origin', 'current']
+META_ALT_COLUMNS = META_COLUMNS + ['id_alt']
+
+# Result files used for the general bacterial analysis table (workflow, file)
+GBA_FILES = [
+    ('phoenix', 'Phoenix_Summary.tsv'),
+    ('phoenix', 'terra_table.tsv'),
+    ('theiaprok', 'terra_table.tsv'),
+    ('recapp', 'terra_table.tsv')
+]
+
+# Function for normalizing workflow names (same as the CASE statement in meta_alt)
+def clean_workflow(workflow):
+    if 'phoenix' in workflow.lower():
+        return 'phoenix'
+    if 'theiaprok' in workflow.lower():
+        return 'theiaprok'
+    if 'RECAPP' in workflow.upper():
+        return 'recapp'
+    if 'BASESPACE' in workflow.upper():
+        return 'basespace_fetch'
+    return workflow
+
+# Function for converting a meta row to a meta_alt row
+def clean_row(row):
+    row = {col: row.get(col, '') for col in META_COLUMNS}
+    row['workflow'] = clean_workflow(row['workflow'])
+    row['id_alt'] = re.sub('-WA.*', '', row['id'])
+    return row
+
+# Table filters (same as the WHERE clauses of s4-s6)
+def is_gba(row):
+    return row['id'] == 'null' and (row['workflow'], row['file']) in GBA_FILES
+
+def is_fastq(row):
+    return '.fastq.gz' in row['file'] and ('R1' in row['file'] or 'R2' in row['file'])
+
+def is_fasta(row):
+    f = row['file']
+    return '.fasta' in f or f.endswith('.fa') or f.endswith('.fa.gz') or '.fna' in f
+
+# Tables built from meta_alt and the filter used for each
+TABLES = {
+    'meta.clean.csv': lambda row: True,
+    'meta.gba.csv': is_gba,
+    'meta.fastq.csv': is_fastq,
+    'meta.fasta.csv': is_fasta
+}
+
+# Function for building all tables in a single pass over the meta rows
+## rows = iterable of meta rows (dictionaries)
+## exclude = 'current' values already in the tables (incremental builds, skipped in every table)
+## Returns the number of rows written to each table
+def build_tables(rows, outdir, exclude=None):
+    exclude = exclude or set()
+    seen = set()
+    counts = {'meta.raw.csv': 0}
+    files = {}
+    writers = {}
+    try:
+        for table, columns in [('meta.raw.csv', META_COLUMNS)] + [(table, META_ALT_COLUMNS) for table in TABLES]:
+            files[table] = open(os.path.join(outdir, table), 'w', newline='')
+            writers[table] = csv.DictWriter(files[table], fieldnames=columns, quoting=csv.QUOTE_ALL, lineterminator='\n', extrasaction='ignore')
+            writers[table].writeheader()
+            counts[table] = 0
+
+        for row in rows:
+            # meta.raw.csv contains every row that is not in the tables yet
+            alt = clean_row(row)
+            if alt['current'] in exclude:
+                continue
+            writers['meta.raw.csv'].writerow(row)
+            counts['meta.raw.csv'] += 1
+
+            # the other tables contain distinct meta_alt rows
+            digest = hashlib.blake2b("\x1f".join(alt.values()).encode('utf-8'), digest_size=16).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            for table, keep in TABLES.items():
+                if keep(alt):
+                    writers[table].writerow(alt)
+                    counts[table] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+# Function for reading the rows of local meta files
+def read_meta_files(paths):
+    for path in paths:
+        with open(path, newline='') as f:
+            yield from csv.DictReader(f)
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='local_builder.py',
+                        description='Build the res2tbl tables from local meta files.')
+    parser.add_argument('-i',
+                        '--input',
+                        nargs = "+",
+                        help = 'Meta files (meta/*.csv)')
+    parser.add_argument('-o',
+                        '--outdir',
+                        default = '.',
+                        help = 'Output directory (Default: current directory)')
+    args = parser.parse_args()
+
+    #------ BUILD TABLES ------#
+    counts = build_tables(read_meta_files(args.input), args.outdir)
+    for table, count in counts.items():
+        print(f'{table}: {count} rows')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Reads the res2tbl tables (meta.raw, meta.clean, meta.gba, meta.fastq, meta.fasta) without Athena.
+Parquet tables (s3://bucket/key/meta.*/workflow=*/) are read by column and workflow partition.
+CSV tables (s3://bucket/key/meta.*.csv) are read in full.
+"""
+import argparse
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+
+# Function for reading a table
+## columns = list of columns to read (default: all)
+## workflows = list of workflow partitions to read (default: all)
+def read_table(path, columns=None, workflows=None):
+    if path.endswith('.csv'):
+        dataset = ds.dataset(path, format='csv')
+    else:
+        dataset = ds.dataset(path.rstrip('/'), format='parquet', partitioning='hive')
+    row_filter = ds.field('workflow').isin(workflows) if workflows else None
+    return dataset.to_table(columns=columns, filter=row_filter)
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='read_table.py',
+                        description='Read a res2tbl table without Athena.')
+    parser.add_argument('-t',
+                        '--table',
+                        help = 'Path to the table (e.g., s3://bucket/tables/meta.fastq or s3://bucket/tables/meta.fastq.csv)')
+    parser.add_argument('-c',
+                        '--columns',
+                        nargs = "*",
+                        help = 'Columns to read. Multiple columns separated by spaces can be supplied (Default: all columns).')
+    parser.add_argument('-w',
+                        '--workflows',
+                        nargs = "*",
+                        help = 'Workflows to read. Multiple workflows separated by spaces can be supplied (Default: all workflows).')
+    parser.add_argument('-o',
+                        '--output',
+                        default = 'table.csv',
+                        help = 'Output CSV file (Default: table.csv)')
+    args = parser.parse_args()
+
+    #------ READ TABLE ------#
+    table = read_table(args.table, args.columns, args.workflows)
+    print(f'{table.num_rows} rows read from {args.table}')
+    pcsv.write_csv(table, args.output)
@@ -9,6 +9,16 @@ TERRA_SUBMISSIONENTITY=$5
 OUTDIR=$6
 GCRED=$7
 
+#----- ARRAY JOBS -----#
+# each child of an array job reads its run from the run list (submission ID, workflow and entity separated by tabs)
+if [[ -n "${TERRA_RUNS}" && -n "${AWS_BATCH_JOB_ARRAY_INDEX}" ]]
+then
+    RUN=$(aws s3 cp ${TERRA_RUNS} - | sed -n "$((AWS_BATCH_JOB_ARRAY_INDEX + 1))p")
+    TERRA_SUBMISSIONID=$(echo "${RUN}" | cut -f 1)
+    TERRA_WORKFLOW=$(echo "${RUN}" | cut -f 2)
+    TERRA_SUBMISSIONENTITY=$(echo "${RUN}" | cut -f 3)
+fi
+
 #----- REPORT INPUTS -----#
 echo -e "\nInput Summary:"
 echo "TERRA_PROJECT: ${TERRA_PROJECT}"
@@ -43,6 +53,8 @@ PREFIX=$(cat .nextflow.log | grep "Files will be saved with prefix:" | cut -f 4
 aws s3 cp .nextflow.log ${OUTDIR%%/}/logs/${PREFIX}-waphl-terra2res.log
 
 #----- CACHE SUBMISSION ID -----#
+# one object per submission ID, so concurrent jobs never overwrite each other
+# terraRunChecker compacts these objects into cache/terra/${TERRA_PROJECT}/${TERRA_WORKSPACE}.manifest.json
 touch empty_file && aws s3 cp empty_file "s3://${OUTDIR}/cache/terra/${TERRA_PROJECT}/${TERRA_WORKSPACE}/${TERRA_SUBMISSIONID}"
 
 echo -e "\nPipeline Complete!"
@@ -6,9 +6,11 @@
 
 import argparse
 import csv
+import hashlib
 import logging
 import sys
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 logger = logging.getLogger()
@@ -20,7 +22,9 @@ class RowChecker:
 
     Attributes:
         modified (list): A list of dicts, where each dict corresponds to a previously
-            validated and transformed row. The order of rows is maintained.
+            validated and transformed row. The order of rows is maintained. Empty if
+            the rows are not kept.
+        count (int): The number of validated rows.
 
     """
 
@@ -35,6 +39,7 @@ class RowChecker:
         first_col="fastq_1",
         second_col="fastq_2",
         single_col="single_end",
+        keep_rows=True,
         **kwargs,
     ):
         """
@@ -50,6 +55,9 @@ class RowChecker:
             single_col (str): The name of the new column that will be inserted and
                 records whether the sample contains single- or paired-end sequencing
                 reads (default "single_end").
+            keep_rows (bool): Whether validated rows are kept in ``modified``. When
+                False, only a compact digest of each sample and FASTQ pair is kept
+                (default True).
 
         """
         super().__init__(**kwargs)
@@ -57,12 +65,32 @@ class RowChecker:
         self._first_col = first_col
         self._second_col = second_col
         self._single_col = single_col
+        self._keep_rows = keep_rows
         self._seen = set()
         self.modified = []
+        self.count = 0
 
     def validate_and_transform(self, row):
         """
-        Perform all validations on the given row and insert the read pairing status.
+        Perform all validations on the given row, insert the read pairing status and record the row.
+
+        Args:
+            row (dict): A mapping from column headers (keys) to elements of that row
+                (values).
+
+        """
+        self.transform(row)
+        if self._keep_rows:
+            self._seen.add((row[self._sample_col], row[self._first_col]))
+            self.modified.append(row)
+        else:
+            key = f"{row[self._sample_col]}\t{row[self._first_col]}".encode()
+            self._seen.add(hashlib.blake2b(key, digest_size=16).digest())
+        self.count += 1
+
+    def transform(self, row):
+        """
+        Perform all validations on the given row and insert the read pairing status, without recording the row.
 
         Args:
             row (dict): A mapping from column headers (keys) to elements of that row
@@ -73,8 +101,6 @@ class RowChecker:
         self._validate_first(row)
         self._validate_second(row)
         self._validate_pair(row)
-        self._seen.add((row[self._sample_col], row[self._first_col]))
-        self.modified.append(row)
 
     def _validate_sample(self, row):
         """Assert that the sample name exists and convert spaces to underscores."""
@@ -121,7 +147,7 @@ class RowChecker:
         number of times the same sample exist, but with different FASTQ files, e.g., multiple runs per experiment.
 
         """
-        if len(self._seen) != len(self.modified):
+        if len(self._seen) != self.count:
             raise AssertionError("The pair of sample name and FASTQ must be unique.")
         seen = Counter()
         for row in self.modified:
@@ -162,7 +188,87 @@ def sniff_format(handle):
     return dialect
 
 
-def check_samplesheet(file_in, file_out):
+def remote_exists(uri):
+    """
+    Check whether a remote file exists with a HEAD request.
+
+    Args:
+        uri (str): An s3:// or gs:// path.
+
+    Returns:
+        bool: Whether the file exists.
+
+    Raises:
+        PermissionError: If access to the file is denied.
+
+    """
+    bucket, _, key = uri.split("://", 1)[1].partition("/")
+    if uri.startswith("s3://"):
+        import botocore.exceptions
+
+        try:
+            _client("s3").head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            if error.response["Error"]["Code"] in ("403", "AccessDenied", "Forbidden"):
+                raise PermissionError(uri) from error
+            raise
+        return True
+    from google.api_core import exceptions
+
+    try:
+        return _client("gs").bucket(bucket).blob(key).exists()
+    except exceptions.Forbidden as error:
+        raise PermissionError(uri) from error
+
+
+def remote_problem(uri):
+    """Return why a remote file cannot be used ("does not exist" or "access denied"), or None if it exists."""
+    try:
+        return None if remote_exists(uri) else "does not exist"
+    except PermissionError:
+        return "access denied"
+
+
+_CLIENTS = {}
+
+
+def _client(scheme):
+    """Create the storage client for a scheme once, so that it is shared by all checks."""
+    if scheme not in _CLIENTS:
+        if scheme == "s3":
+            import boto3
+
+            _CLIENTS[scheme] = boto3.client("s3")
+        else:
+            from google.cloud import storage
+
+            _CLIENTS[scheme] = storage.Client()
+    return _CLIENTS[scheme]
+
+
+def verify_remote(uris, threads=16):
+    """
+    Check that every s3:// and gs:// FASTQ file exists, with a bounded pool of concurrent checks.
+
+    Args:
+        uris (list): FASTQ paths. Paths that are not on S3 or Google Cloud Storage are skipped.
+        threads (int): The number of files checked at the same time.
+
+    Returns:
+        list: The paths that do not exist or cannot be accessed, with the reason, in the order given.
+
+    """
+    remote = list(dict.fromkeys(uri for uri in uris if uri.startswith(("s3://", "gs://"))))
+    for scheme in {uri.split("://")[0] for uri in remote}:
+        _client(scheme)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        problems = list(executor.map(remote_problem, remote))
+    return [f"{uri} ({problem})" for uri, problem in zip(remote, problems) if problem]
+
+
+def check_samplesheet(file_in, file_out, streaming=False, verify=False, threads=16):
     """
     Check that the tabular samplesheet has the structure expected by nf-core pipelines.
 
@@ -174,6 +280,11 @@ def check_samplesheet(file_in, file_out):
             CSV, TSV, or any other format automatically recognized by ``csv.Sniffer``.
         file_out (pathlib.Path): Where the validated and transformed samplesheet should
             be created; always in CSV format.
+        streaming (bool): Validate the samplesheet in a first pass and write it in a
+            second pass, so that rows are not held in memory.
+        verify (bool): Check that every s3:// and gs:// FASTQ file exists before the
+            samplesheet is written. All missing files are reported together.
+        threads (int): The number of remote files checked at the same time.
 
     Example:
         This function checks that the samplesheet follows the following structure,
@@ -198,22 +309,46 @@ def check_samplesheet(file_in, file_out):
             logger.critical(f"The sample sheet **must** contain these column headers: {req_cols}.")
             sys.exit(1)
         # Validate each row.
-        checker = RowChecker()
+        checker = RowChecker(keep_rows=not streaming)
+        fastqs = []
         for i, row in enumerate(reader):
             try:
                 checker.validate_and_transform(row)
             except AssertionError as error:
                 logger.critical(f"{str(error)} On line {i + 2}.")
                 sys.exit(1)
-        checker.validate_unique_samples()
+            if verify:
+                fastqs.extend(path for path in (row["fastq_1"], row["fastq_2"]) if path)
+        try:
+            checker.validate_unique_samples()
+        except AssertionError as error:
+            logger.critical(str(error))
+            sys.exit(1)
+    if verify:
+        missing = verify_remote(fastqs, threads)
+        if missing:
+            logger.critical(f"{len(missing)} FASTQ files do not exist or cannot be accessed:\n" + "\n".join(missing))
+            sys.exit(1)
     header = list(reader.fieldnames)
     header.insert(1, "single_end")
     # See https://docs.python.org/3.9/library/csv.html#id3 to read up on `newline=""`.
     with file_out.open(mode="w", newline="") as out_handle:
         writer = csv.DictWriter(out_handle, header, delimiter=",")
         writer.writeheader()
-        for row in checker.modified:
-            writer.writerow(row)
+        if not streaming:
+            for row in checker.modified:
+                writer.writerow(row)
+            return
+        # Second pass: transform (without recording again) and rename each row as it is read, counting the times each sample was seen.
+        seen = Counter()
+        with file_in.open(newline="") as in_handle:
+            reader = csv.DictReader(in_handle, dialect=sniff_format(in_handle))
+            for row in reader:
+                checker.transform(row)
+                sample = row["sample"]
+                seen[sample] += 1
+                row["sample"] = f"{sample}_T{seen[sample]}"
+                writer.writerow(row)
 
 
 def parse_args(argv=None):
@@ -234,6 +369,24 @@ def parse_args(argv=None):
         type=Path,
         help="Transformed output samplesheet in CSV format.",
     )
+    parser.add_argument(
+        "-s",
+        "--streaming",
+        help="Validate and write the samplesheet in two passes without holding rows in memory.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify-remote",
+        help="Check that every s3:// and gs:// FASTQ file exists before writing the samplesheet.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="The number of remote FASTQ files checked at the same time (default 16).",
+        type=int,
+        default=16,
+    )
     parser.add_argument(
         "-l",
         "--log-level",
@@ -252,7 +405,7 @@ def main(argv=None):
         logger.error(f"The given input file {args.file_in} was not found!")
         sys.exit(2)
     args.file_out.parent.mkdir(parents=True, exist_ok=True)
-    check_samplesheet(args.file_in, args.file_out)
+    check_samplesheet(args.file_in, args.file_out, args.streaming, args.verify_remote, args.threads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import argparse
+import ast
+import csv
+import gzip
+import re
+import sys
+
+# Google files in free text
+GS_PATTERN = re.compile(r'''gs://[^\s,;'"\[\]]+''')
+
+# Function for getting the Google files in a value
+## Values can hold one file (kept whole, so commas in file names are kept), a list of files or free text
+def gs_files(value):
+    value = value.strip()
+    if value.startswith('gs://'):
+        return [value]
+    if value.startswith('['):
+        try:
+            items = ast.literal_eval(value)
+            return [item for item in items if isinstance(item, str) and item.startswith('gs://')]
+        except (ValueError, SyntaxError):
+            pass
+    return GS_PATTERN.findall(value)
+
+# Function for opening plain or gzipped text files
+def open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+# Function for streaming the id,file pairs of a Terra table
+## The first column is the sample ID (spaces are replaced with underscores)
+## dedup = True skips pairs that were already written
+def col_files(rows, dedup=False):
+    seen = set()
+    for row in rows:
+        if not row:
+            continue
+        id = row[0].replace(' ', '_')
+        for value in row[1:]:
+            if 'gs://' not in value:
+                continue
+            for uri in gs_files(value):
+                if dedup:
+                    if (id, uri) in seen:
+                        continue
+                    seen.add((id, uri))
+                yield id, uri
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='col_files.py',
+                        description='List the Google files in each row of a Terra table as id,file pairs.')
+    parser.add_argument('input',
+                        help = 'Terra table (TSV, can be gzipped)')
+    parser.add_argument('-o',
+                        '--output',
+                        help = 'Output file (Default: <input>.csv, or <input>.csv.gz with --gzip)')
+    parser.add_argument('-d',
+                        '--dedup',
+                        action = 'store_true',
+                        help = 'Write each id,file pair only once')
+    parser.add_argument('-z',
+                        '--gzip',
+                        action = 'store_true',
+                        help = 'Gzip the output')
+    args = parser.parse_args()
+
+    output = args.output or re.sub(r'\.tsv(\.gz)?$', '', args.input) + ('.csv.gz' if args.gzip else '.csv')
+    if args.gzip and not output.endswith('.gz'):
+        output += '.gz'
+
+    #------ LIST FILES ------#
+    # values are separated by tabs only (no quoting), so commas in values are kept
+    csv.field_size_limit(sys.maxsize)
+    with open_text(args.input, 'r') as infile, open_text(output, 'w') as outfile:
+        rows = csv.reader(infile, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(rows, None) # header
+        csv.writer(outfile, lineterminator='\n').writerows(col_files(rows, args.dedup))
@@ -1,40 +1,112 @@
 #!/usr/bin/env python
 
 # -*- coding: utf-8 -*-
-"""Download a remote tsv from a Terra workspace data model when it is too large to export from Terra UI."""
+"""Download a remote tsv from a Terra workspace data model when it is too large to export from Terra UI.
+
+The output format follows the file extension: .tsv, .tsv.gz (gzip), .tsv.zst (zstd, requires zstandard) or .parquet (requires pyarrow).
+"""
 from firecloud import api as fapi
+from terra_client import TerraClient
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import gzip
+import inspect
+import json
 import math
+import os
 
 DEFAULT_PAGE_SIZE = 1000
+DEFAULT_THREADS = 4
+# older versions of the Firecloud API cannot select the attributes returned by an entity query
+FIELDS_SUPPORTED = 'fields' in inspect.signature(fapi.get_entities_query).parameters
 
 
-def get_entity_by_page(project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None):
-    """Get entities from workspace by page given a page_size(number of entities/rows in entity table)."""
-    # API = https://api.firecloud.org/#!/Entities/entityQuery
-    response = fapi.get_entities_query(project, workspace, entity_type, page=page,
-                                       page_size=page_size, sort_direction=sort_direction,
-                                       filter_terms=filter_terms)
-
-    if response.status_code != 200:
-        print(response.text)
-        exit(1)
-
-    return(response.json())
+def get_entity_by_page(client, project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None, fields=None):
+    """Get entities from workspace by page given a page_size(number of entities/rows in entity table).
 
-
-def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None):
-    """Download large TSV file from Terra workspace by designated number of rows."""
+    Throttling (429), server errors (5xx) and connection errors are retried by the client.
+    fields = comma-separated attributes to return (all attributes if None)
+    """
+    # API = https://api.firecloud.org/#!/Entities/entityQuery
+    query_fields = {'fields': fields} if fields and FIELDS_SUPPORTED else {}
+    return client.get_entities_query(project, workspace, entity_type, page=page,
+                                     page_size=page_size, sort_direction=sort_direction,
+                                     filter_terms=filter_terms, **query_fields)
+
+
+def output_format(tsv_name):
+    """Get the output format from the file extension."""
+    if tsv_name.endswith('.parquet'):
+        return 'parquet'
+    if tsv_name.endswith('.gz'):
+        return 'gzip'
+    if tsv_name.endswith(('.zst', '.zstd')):
+        return 'zstd'
+    return 'tsv'
+
+
+def encode_rows(rows, fmt):
+    """Encode rows as tsv text, compressed as its own gzip member or zstd frame (members/frames can be concatenated, so pages are appended independently)."""
+    data = "".join("\t".join(values) + "\n" for values in rows).encode('utf-8')
+    if fmt == 'gzip':
+        return gzip.compress(data)
+    if fmt == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def read_checkpoint(checkpoint_name):
+    """Read the checkpoint of an interrupted export (None if there is no checkpoint)."""
+    if not os.path.exists(checkpoint_name):
+        return None
+    with open(checkpoint_name) as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint_name, checkpoint):
+    """Save the checkpoint (pages written and size of the tsv file after them) without leaving a partial file."""
+    with open(checkpoint_name + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_name + '.tmp', checkpoint_name)
+
+
+def fetch_pages(client, project, workspace, entity_type, num_pages, page_size=DEFAULT_PAGE_SIZE, threads=DEFAULT_THREADS, first_page=1, fields=None):
+    """Yield pages in order while up to 2 * threads pages are fetched concurrently (memory is bounded by the pages in flight)."""
+    def get_page(page):
+        return get_entity_by_page(client, project, workspace, entity_type, page, page_size, fields=fields)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pages = iter(range(first_page, num_pages + 1))
+        in_flight = deque()
+        for page in pages:
+            in_flight.append(executor.submit(get_page, page))
+            if len(in_flight) >= 2 * threads:
+                break
+        while in_flight:
+            page_response = in_flight.popleft().result()
+            next_page = next(pages, None)
+            if next_page is not None:
+                in_flight.append(executor.submit(get_page, next_page))
+            yield page_response
+
+
+def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None, threads=DEFAULT_THREADS, resume=False):
+    """Download large TSV file from Terra workspace by designated number of rows.
+
+    Completed pages are recorded in a checkpoint file (tsv_name + '.checkpoint').
+    With resume=True an interrupted export continues after the last page that was written (not available for Parquet).
+    """
+    fmt = output_format(tsv_name)
     # get all entity types in workspace using API call
+    # not cached: the entity count sets the number of pages, so a cached count could miss the newest rows
     # API = https://api.firecloud.org/#!/Entities/getEntityTypes
-    response = fapi.list_entity_types(project, workspace)
-    if response.status_code != 200:
-        print(response.text)
-        exit(1)
+    client = TerraClient(pool_size=2 * threads)
+    entity_types_json = client.list_entity_types(project, workspace, cache=False)
 
     # get/report # of entities + associated attributes(column names) of input entity type
-    entity_types_json = response.json()
     entity_count = entity_types_json[entity_type]["count"]
     entity_id = entity_types_json[entity_type]["idName"]
     # if user provided list of specific attributes to return, else return all attributes
@@ -42,30 +114,53 @@ def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_
         all_attribute_names = entity_types_json[entity_type]["attributeNames"]
         attribute_names = [attr for attr in all_attribute_names if attr in attr_list]
     else:
-        attribute_names = entity_types_json[entity_type]["attributeNames"]
+        attribute_names = list(entity_types_json[entity_type]["attributeNames"])
+
+    # only request the selected attributes from Terra
+    fields = ",".join(attribute_names) if attr_list else None
 
     # add the entity_id value to list of attributes (not a default attribute of API response)
     attribute_names.insert(0, entity_id)
 
     print(f'{entity_count} {entity_type}(s) to export.')
 
-    with open(tsv_name, "w") as tsvout:
-        # add header with attribute values to tsv
-        tsvout.write("\t".join(attribute_names) + "\n")
+    # continue from the checkpoint if it belongs to the same export
+    checkpoint_name = tsv_name + '.checkpoint'
+    checkpoint = read_checkpoint(checkpoint_name) if resume and fmt != 'parquet' else None
+    if checkpoint and (checkpoint['page_size'] != page_size or checkpoint['attributes'] != attribute_names or not os.path.exists(tsv_name)):
+        print(f'{checkpoint_name} does not match this export. Starting from the first page.')
+        checkpoint = None
+
+    # Parquet output: one row group per page, every column as text with the entity ID first
+    parquet = None
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(name, pa.string()) for name in attribute_names])
+        parquet = pq.ParquetWriter(tsv_name, schema)
+
+    with open(os.devnull if parquet else tsv_name, "r+b" if checkpoint else "wb") as tsvout:
+        if checkpoint:
+            # drop anything written after the last completed page
+            tsvout.truncate(checkpoint['bytes'])
+            tsvout.seek(checkpoint['bytes'])
+            print(f'Resuming after page {checkpoint["pages"]}.')
+        else:
+            # add header with attribute values to tsv
+            if not parquet:
+                tsvout.write(encode_rows([attribute_names], fmt))
+            checkpoint = {'page_size': page_size, 'attributes': attribute_names, 'pages': 0, 'rows': 0, 'bytes': tsvout.tell()}
         # set starting row value and calculate number of pages
-        row_num = 0
+        row_num = checkpoint['rows']
         num_pages = int(math.ceil(float(entity_count) / page_size))
 
         # get entities by page where each page has page_size # of rows using API call
-        print(f'Getting all {num_pages} pages of entity data.')
-        all_page_responses = []
-        for page in tqdm(range(1, num_pages + 1)):
-            all_page_responses.append(get_entity_by_page(project, workspace, entity_type, page, page_size))
-
-        # for each response(page) in all_page_responses[] - contains parameter metadata
-        print(f'Writing {entity_count} attributes to tsv file.')
-        for page_response in tqdm(all_page_responses):
+        # pages are fetched concurrently and written in order as soon as they arrive
+        print(f'Getting {num_pages - checkpoint["pages"]} of {num_pages} pages of entity data and writing {entity_count} attributes to tsv file.')
+        first_page = checkpoint['pages'] + 1
+        for page, page_response in enumerate(tqdm(fetch_pages(client, project, workspace, entity_type, num_pages, page_size, threads, first_page, fields), total=num_pages, initial=first_page - 1), first_page):
             # for each set of attributes in results (no parameters) get attribute names and entity_id(name)
+            rows = []
             for entity_json in page_response["results"]:
                 attributes = entity_json["attributes"]
                 name = entity_json["name"]
@@ -82,10 +177,26 @@ def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_
 
                     values.append(str(value))
 
-                tsvout.write("\t".join(values) + "\n")
+                rows.append(values)
                 row_num += 1
 
+            if parquet:
+                parquet.write_table(pa.table([[values[i] for values in rows] for i in range(len(attribute_names))], schema=schema))
+                continue
+            tsvout.write(encode_rows(rows, fmt))
+
+            # record the completed page
+            tsvout.flush()
+            checkpoint.update({'pages': page, 'rows': row_num, 'bytes': tsvout.tell()})
+            write_checkpoint(checkpoint_name, checkpoint)
+
+    # the export is complete
+    if parquet:
+        parquet.close()
+    if os.path.exists(checkpoint_name):
+        os.remove(checkpoint_name)
     print(f'Finished exporting {entity_type}(s) to tsv with name {tsv_name}.')
+    client.print_stats()
 
 
 if __name__ == "__main__":
@@ -95,9 +206,11 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
     parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
     parser.add_argument('-e', '--entity_type', type=str, required=True, help='Entity type being requested for tsv export to local destination.')
-    parser.add_argument('-f', '--tsv_filename', type=str, required=True, help='Name of tsv file to be exported from Terra to local destination.')
+    parser.add_argument('-f', '--tsv_filename', type=str, required=True, help='Name of tsv file to be exported from Terra to local destination. The extension sets the format: .tsv, .tsv.gz, .tsv.zst or .parquet.')
     parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to export per page.')
     parser.add_argument('-a', '--attribute_list', nargs='+', help='column names to return - separated by spaces. ex. -a col1 col2')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS, help='Number of pages to fetch at the same time.')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue an interrupted export from the last completed page (uses <tsv_filename>.checkpoint).')
 
     args = parser.parse_args()
-    download_tsv_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list)
+    download_tsv_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list, args.threads, args.resume)
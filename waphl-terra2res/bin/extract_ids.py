@@ -1,29 +1,68 @@
 #!/usr/bin/env python
 
 import argparse
+import csv
 import re
-#----- ARGUMENTS -----#
-parser = argparse.ArgumentParser(
-                    prog='get_timestamp.py',
-                    description='Get Google object timestamp.')
-parser.add_argument('-i',
-                    '--input',
-                    help = 'Google file')
-parser.add_argument('--patterns',
-                    nargs = "*",
-                    help = 'String patterns that should be extracted from the sample name. Only samples that match one of these pattern will be transferred. Multiple patterns separated by spaces can be supplied (Default: "*").')
-args = parser.parse_args()
-
-#------ GET SAMPLEID ------#
-id = None
-for pattern in args.patterns:
-    match = re.search(pattern, args.input)
-    if match:
-        id = match.group()
-
-print(id)
-
-# write file
-f = open("ids.csv", "w")
-f.write(str(id))
-f.close()
\ No newline at end of file
+import sys
+
+# Function for compiling the ID patterns in the order they are tried
+## priority = 'last' (a later pattern wins when several match, the default) or 'first' (an earlier pattern wins)
+def compile_patterns(patterns, priority='last'):
+    ordered = list(reversed(patterns)) if priority == 'last' else list(patterns)
+    return [ re.compile(pattern) for pattern in ordered ]
+
+# Function for extracting the ID from a name (None if no pattern matches)
+def extract_id(name, compiled):
+    for pattern in compiled:
+        match = pattern.search(name)
+        if match:
+            return match.group()
+    return None
+
+if __name__ == '__main__':
+    #----- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='extract_ids.py',
+                        description='Extract sample IDs from sample names.')
+    parser.add_argument('-i',
+                        '--input',
+                        help = 'Sample name')
+    parser.add_argument('-b',
+                        '--batch',
+                        help = 'File of sample names (one per line, "-" for stdin). Writes a name,id table.')
+    parser.add_argument('--patterns',
+                        nargs = "*",
+                        help = 'String patterns that should be extracted from the sample name. Only samples that match one of these pattern will be transferred. Multiple patterns separated by spaces can be supplied (Default: "*").')
+    parser.add_argument('--priority',
+                        choices = ['last', 'first'],
+                        default = 'last',
+                        help = 'Pattern that is used when several patterns match: the last or the first one supplied (Default: last)')
+    parser.add_argument('-o',
+                        '--output',
+                        default = 'ids.csv',
+                        help = 'Output file (Default: ids.csv)')
+    args = parser.parse_args()
+
+    matcher = compile_patterns(args.patterns, args.priority)
+
+    #------ GET SAMPLEIDS (BATCH) ------#
+    if args.batch:
+        names = sys.stdin if args.batch == '-' else open(args.batch)
+        with open(args.output, "w", newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['name', 'id'])
+            for name in names:
+                name = name.rstrip('\n')
+                if name:
+                    writer.writerow([name, str(extract_id(name, matcher))])
+
+    #------ GET SAMPLEID ------#
+    else:
+        id = extract_id(args.input, matcher)
+
+        print(id)
+
+        # write file
+        f = open(args.output, "w")
+        f.write(str(id))
+        f.close()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 import os
+import csv
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
 
 #----- ARGUMENTS -----#
@@ -11,27 +13,85 @@ parser = argparse.ArgumentParser(
 parser.add_argument('-i',
                     '--input',
                     help = 'Google file')
+parser.add_argument('-b',
+                    '--batch',
+                    help = 'File of Google files (one per line). Timestamps are listed by bucket and prefix instead of one request per file.')
 parser.add_argument('-p',
                     '--project',
                     help = 'Google project')
+parser.add_argument('-d',
+                    '--depth',
+                    type = int,
+                    default = 2,
+                    help = 'Batch mode: files are grouped by the first <depth> folders of their path, e.g., submissions/<submission ID>/ (Default: 2)')
+parser.add_argument('-t',
+                    '--threads',
+                    type = int,
+                    default = 4,
+                    help = 'Batch mode: number of groups listed at the same time (Default: 4)')
+parser.add_argument('-o',
+                    '--output',
+                    default = 'timestamp.csv',
+                    help = 'Output file (Default: timestamp.csv)')
 args = parser.parse_args()
 
 # set Google project
 os.environ.setdefault("GCLOUD_PROJECT", args.project)
 
-#------ GET TIMESTAMP ------#
-gs_path = args.input.split('gs://')[1] # bucket/path/to/file.txt
-gs_bucket = gs_path.split('/')[0] # bucket
-gs_blob = '/'.join(gs_path.split('/')[1:]) # path/to/file.txt
+# Function for splitting a Google path into the bucket and blob name
+def split_uri(uri):
+    gs_path = uri.split('gs://')[1] # bucket/path/to/file.txt
+    return gs_path.split('/')[0], '/'.join(gs_path.split('/')[1:]) # bucket, path/to/file.txt
+
+# Function for getting the timestamps of a group of files in the same bucket with one paginated listing
+## The listing starts at the longest prefix shared by the files
+def list_timestamps(client, gs_bucket, blobs):
+    prefix = os.path.commonprefix(blobs)
+    wanted = set(blobs)
+    timestamps = {}
+    for blob in client.list_blobs(gs_bucket, prefix=prefix, fields='items(name,timeCreated),nextPageToken'):
+        if blob.name in wanted:
+            timestamps[f'gs://{gs_bucket}/{blob.name}'] = blob.time_created.timestamp()
+    return timestamps
 
 storage_client = storage.Client()
-bucket = storage_client.bucket(gs_bucket)
-blob = bucket.get_blob(gs_blob)
-file_time = None
-if blob.exists():
-    file_time = blob.time_created.timestamp()
-
-# write file
-results = [ str(args.input), str(file_time) ]
-with open("timestamp.csv", "w") as outfile:
-    outfile.write(",".join(results))
\ No newline at end of file
+
+#------ GET TIMESTAMPS (BATCH) ------#
+if args.batch:
+    with open(args.batch) as f:
+        uris = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    # group files by bucket and leading folders
+    groups = {}
+    for uri in uris:
+        gs_bucket, gs_blob = split_uri(uri)
+        group = (gs_bucket, '/'.join(gs_blob.split('/')[:args.depth]))
+        groups.setdefault(group, []).append(gs_blob)
+
+    # list each group (the client is shared)
+    timestamps = {}
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for group_times in executor.map(lambda group: list_timestamps(storage_client, group[0][0], group[1]), groups.items()):
+            timestamps.update(group_times)
+    print(f'{len(timestamps)} of {len(uris)} files found with {len(groups)} listings')
+
+    # write file (files that do not exist get a timestamp of None)
+    with open(args.output, "w", newline='') as outfile:
+        writer = csv.writer(outfile, lineterminator='\n')
+        for uri in uris:
+            writer.writerow([ uri, str(timestamps.get(uri)) ])
+
+#------ GET TIMESTAMP ------#
+else:
+    gs_bucket, gs_blob = split_uri(args.input)
+
+    bucket = storage_client.bucket(gs_bucket)
+    blob = bucket.get_blob(gs_blob)
+    file_time = None
+    if blob.exists():
+        file_time = blob.time_created.timestamp()
+
+    # write file
+    results = [ str(args.input), str(file_time) ]
+    with open(args.output, "w") as outfile:
+        outfile.write(",".join(results))
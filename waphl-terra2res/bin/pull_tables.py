@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
-import firecloud.api as fapi
+from terra_client import TerraClient
 
 #----- ARGUMENTS -----#
 parser = argparse.ArgumentParser(
@@ -17,7 +17,8 @@ args = parser.parse_args()
 
 #------ DOWNLOAD ALL TABLES FOR WORKSPACE ------#
 # get list of tables in workspace
-all_tables = fapi.list_entity_types(args.project, args.workspace).json()
+client = TerraClient()
+all_tables = client.list_entity_types(args.project, args.workspace)
 select_tables = []
 # download tables
 for table in all_tables:
@@ -26,4 +27,5 @@ for table in all_tables:
 
 # write file
 with open("tables.csv", "w") as outfile:
-    outfile.write("\n".join(select_tables))
\ No newline at end of file
+    outfile.write("\n".join(select_tables))
+client.print_stats()
\ No newline at end of file
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Shared Terra (Firecloud API) client for the waphl-terra2res tools.
+
+- one pooled HTTP session for every request
+- retries with exponential backoff on throttling (429), server errors (5xx) and connection errors
+- a TTL cache for workspace metadata (e.g., entity types), optionally saved to a file so that other processes can reuse it
+- latency counters for each endpoint
+
+The cache file and TTL can also be set with the TERRA_CACHE_FILE and TERRA_CACHE_TTL environment variables.
+"""
+from firecloud import api as fapi
+from requests.adapters import HTTPAdapter
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+DEFAULT_CACHE_TTL = 300
+DEFAULT_RETRIES = 5
+
+class TerraClient:
+    def __init__(self, cache_file=None, cache_ttl=None, retries=DEFAULT_RETRIES, pool_size=16):
+        self.cache_file = cache_file or os.environ.get('TERRA_CACHE_FILE')
+        self.cache_ttl = float(cache_ttl if cache_ttl is not None else os.environ.get('TERRA_CACHE_TTL', DEFAULT_CACHE_TTL))
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.cache = self._load_cache()
+
+        # the Firecloud API keeps one session for all requests; allow pool_size connections to be reused at the same time
+        fapi._set_session()
+        session = getattr(fapi, '__SESSION', None)
+        if session is not None:
+            session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    #----- CACHE -----#
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        # write to a temporary file first so other processes never read a partial cache
+        tmp = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_file)
+
+    #----- REQUESTS -----#
+    # Function for calling a Firecloud API endpoint with retries
+    ## Returns the JSON body of the response, from the cache when cache = True and the cached copy is younger than the TTL
+    def call(self, endpoint, *args, cache=False, **kwargs):
+        key = json.dumps([endpoint, args, kwargs], sort_keys=True)
+        if cache:
+            with self.lock:
+                cached = self.cache.get(key)
+            if cached and time.time() - cached[0] < self.cache_ttl:
+                self._count(endpoint, 0, cached=True)
+                return cached[1]
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = getattr(fapi, endpoint)(*args, **kwargs)
+                status, error = response.status_code, f'{response.status_code}: {response.text}'
+            except IOError as e:
+                status, error = None, str(e)
+            self._count(endpoint, time.perf_counter() - start, error=status != 200)
+            if status == 200:
+                break
+            request = f'{endpoint}{args}' + (f' {kwargs}' if kwargs else '')
+            if status is not None and status != 429 and status < 500 or attempt == self.retries:
+                raise RuntimeError(f'{request} failed: {error}')
+            delay = 2 ** attempt + random.uniform(0, 1)
+            print(f'{request} failed ({error}). Retrying in {delay:.1f} seconds.', file=sys.stderr)
+            time.sleep(delay)
+
+        body = response.json()
+        if cache:
+            with self.lock:
+                self.cache[key] = [time.time(), body]
+                self._save_cache()
+        return body
+
+    # Workspace metadata (cached unless cache = False, e.g., when the entity counts must be current)
+    def list_entity_types(self, project, workspace, cache=True):
+        return self.call('list_entity_types', project, workspace, cache=cache)
+
+    def list_submissions(self, project, workspace):
+        return self.call('list_submissions', project, workspace)
+
+    def get_entities_query(self, project, workspace, entity_type, **kwargs):
+        return self.call('get_entities_query', project, workspace, entity_type, **kwargs)
+
+    #----- LATENCY -----#
+    def _count(self, endpoint, seconds, error=False, cached=False):
+        with self.lock:
+            counter = self.latency.setdefault(endpoint, {'calls': 0, 'cached': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            if cached:
+                counter['cached'] += 1
+                return
+            counter['calls'] += 1
+            counter['errors'] += int(error)
+            counter['seconds'] += seconds
+            counter['max_seconds'] = max(counter['max_seconds'], seconds)
+
+    # Function for getting the latency counters of each endpoint
+    def stats(self):
+        with self.lock:
+            return {endpoint: dict(counter, mean_seconds=counter['seconds'] / counter['calls'] if counter['calls'] else 0.0)
+                    for endpoint, counter in self.latency.items()}
+
+    # Function for printing the latency counters (to stderr, so the output of the tools is unchanged)
+    def print_stats(self):
+        for endpoint, counter in self.stats().items():
+            print(f"Terra API {endpoint}: {counter['calls']} calls ({counter['cached']} cached, {counter['errors']} errors), "
+                  f"mean {counter['mean_seconds']:.3f} s, max {counter['max_seconds']:.3f} s", file=sys.stderr)
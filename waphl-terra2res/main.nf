@@ -215,6 +215,9 @@ process MONITOR {
 }
 
 process EXPORT_TABLE {
+    // retries run in a new work directory, so the export and its checkpoint are kept in params.exportdir and resumed from there
+    errorStrategy 'retry'
+    maxRetries 3
 
     input:
     tuple val(project), val(workspace), val(table), val(workflow)
@@ -223,8 +226,11 @@ process EXPORT_TABLE {
     tuple val(workflow), val(table), path('terra_table.tsv'), emit: table
 
     script:
+    def export = "${params.exportdir}/${project}/${workspace}/${workflow}/${table}.tsv"
     """
-    export_large_tsv.py -p ${project} -w ${workspace} -e ${table} -f terra_table.tsv
+    mkdir -p "\$(dirname "${export}")"
+    export_large_tsv.py -p ${project} -w ${workspace} -e ${table} -f "${export}" -r
+    mv "${export}" terra_table.tsv
     """
 }
 
@@ -1,29 +1,164 @@
 """
-Determines new Terra runs using the submission ID and submits an AWS Batch job for each.
+Determines new Terra runs using the submission ID and submits them to AWS Batch (as an array job when there are several), as far as the job queue has room.
 Checks submission ID cache if it is available, otherwise all runs are submitted.
-Cache is updated at the end of batch job
+Cache is updated at the end of batch job (one empty object per submission ID), and these objects are compacted into a manifest for each workspace
+Workspaces are checked concurrently and a report is returned for each workspace
 """
-from firecloud import api as fapi
+from terra_client import TerraClient
 import json
 from datetime import datetime
 import re
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
 import os
 
-def terraRunChecker(project,workspace,bucket,jobqueue,jobdef,gcred):
+# Function for reading the submission ID cache manifest of a workspace
+## Returns the manifest and its ETag (None if the manifest does not exist yet)
+def read_manifest(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return {'version': 0, 'ids': [], 'snapshot': {}}, None
+    return json.loads(response['Body'].read()), response['ETag']
+
+# Function for updating the manifest with a conditional write
+## update = function that changes the manifest in place
+## If another invocation saved the manifest first, it is read again and the update is repeated, so no entries are lost
+def update_manifest(client, bucket, key, update, attempts=5):
+    for attempt in range(attempts):
+        manifest, etag = read_manifest(client, bucket, key)
+        update(manifest)
+        manifest['version'] += 1
+        manifest['ids'] = sorted(set(manifest['ids']))
+        manifest['updated'] = int(time.time())
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest), **condition)
+            return manifest
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict'] or attempt == attempts - 1:
+                raise
+            print(f'WARNING: {key} was changed by another invocation. Retrying.')
+
+# Function for listing the submission IDs cached by the batch jobs (paginated)
+def list_cached_ids(client, bucket, prefix):
+    ids = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        ids.extend(obj['Key'].replace(prefix, '') for obj in page.get('Contents', []))
+    return ids
+
+# Function for removing the cached ID objects once they are in the manifest
+def delete_cached_ids(client, bucket, prefix, ids):
+    keys = [f'{prefix}{id}' for id in ids]
+    for i in range(0, len(keys), 1000):
+        client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys[i:i+1000]], 'Quiet': True})
+
+# Function for counting the jobs in a job queue that have not finished
+## Array jobs count as their number of children that have not finished (children that are done free their slot)
+def count_active_jobs(client, jobqueue):
+    statuses = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING']
+    active = 0
+    array_jobs = set()
+    paginator = client.get_paginator('list_jobs')
+    for status in statuses:
+        for page in paginator.paginate(jobQueue=jobqueue, jobStatus=status):
+            for job in page['jobSummaryList']:
+                if 'arrayProperties' in job:
+                    array_jobs.add(job['jobId'])
+                else:
+                    active += 1
+    for job_id in array_jobs:
+        for status in statuses:
+            for page in paginator.paginate(arrayJobId=job_id, jobStatus=status):
+                active += len(page['jobSummaryList'])
+    return active
+
+# Function for sharing the free slots in the job queue between workspaces
+## demands = number of new runs of each workspace
+## Slots are handed out in equal shares, and slots left over by workspaces with few runs go to the workspaces that still have runs
+## Returns the number of slots granted to each workspace
+def share_slots(slots, demands):
+    granted = [0] * len(demands)
+    left = max(slots, 0)
+    pending = [i for i, d in enumerate(demands) if d > 0]
+    while left > 0 and pending:
+        share = max(left // len(pending), 1)
+        for i in list(pending):
+            taken = min(share, demands[i] - granted[i], left)
+            granted[i] += taken
+            left -= taken
+            if granted[i] == demands[i]:
+                pending.remove(i)
+            if left == 0:
+                break
+    return granted
+
+# Function for submitting runs to AWS Batch
+## A single run is submitted as a job, several runs as an array job
+## Array jobs read their run from a run list saved in the results bucket (one line per child: submission ID, workflow, entity)
+## Returns the job IDs and the run lists saved ({key: job ID})
+def submit_runs(batch_client, s3_client, project, workspace, runs, bucket, jobqueue, jobdef, gcred):
+    if not runs:
+        return [], {}
+    environment = {
+        'TERRA_PROJECT': project,
+        'TERRA_WORKSPACE': workspace,
+        'S3_OUTDIR': bucket,
+        'GCRED': gcred
+    }
+    job = {
+        'jobQueue': jobqueue,
+        'jobDefinition': jobdef
+    }
+    runs_key = None
+    if len(runs) == 1:
+        run, (workflow, entity, _) = next(iter(runs.items()))
+        environment.update({'TERRA_SUBMISSIONID': run, 'TERRA_WORKFLOW': workflow, 'TERRA_SUBMISSIONENTITY': entity})
+        job['jobName'] = f'{project}_{workspace}_{run}'
+    else:
+        runs_key = f'cache/terra/jobs/{project}/{workspace}/{int(time.time())}-{uuid.uuid4().hex}.tsv'
+        body = "".join(f'{run}\t{value[0]}\t{value[1]}\n' for run, value in runs.items())
+        s3_client.put_object(Bucket=bucket, Key=runs_key, Body=body)
+        # placeholders keep the positional arguments of aws-batch-script.sh in place
+        environment.update({'TERRA_SUBMISSIONID': '-', 'TERRA_WORKFLOW': '-', 'TERRA_SUBMISSIONENTITY': '-', 'TERRA_RUNS': f's3://{bucket}/{runs_key}'})
+        job['jobName'] = f'{project}_{workspace}_{len(runs)}runs'
+        job['arrayProperties'] = {'size': len(runs)}
+    response = batch_client.submit_job(
+            **job,
+            containerOverrides={
+                'environment': [ {'name': name, 'value': value} for name, value in environment.items() ],
+                'command': ['bash','-c','git clone https://github.com/DOH-JDJ0303/waphl-data.git && bash waphl-data/waphl-terra2res/aws-batch-script.sh $TERRA_PROJECT $TERRA_WORKSPACE $TERRA_SUBMISSIONID $TERRA_WORKFLOW $TERRA_SUBMISSIONENTITY $S3_OUTDIR $GCRED']
+            }
+        )
+    return [response['jobId']], ({runs_key: response['jobId']} if runs_key else {})
+
+# Function for finding the run lists whose array job is done
+## run_lists = {key: job ID} from the manifest
+## Run lists of jobs that succeeded, failed or are no longer known to AWS Batch are no longer read
+def finished_run_lists(batch_client, run_lists):
+    status = {}
+    job_ids = list(set(run_lists.values()))
+    for i in range(0, len(job_ids), 100):
+        for job in batch_client.describe_jobs(jobs=job_ids[i:i+100])['jobs']:
+            status[job['jobId']] = job['status']
+    return [key for key, job_id in run_lists.items() if status.get(job_id, 'SUCCEEDED') in ['SUCCEEDED', 'FAILED']]
+
+# Function for finding the new runs of a workspace
+## terra_client and s3_client can be shared between workspaces
+## Runs that were submitted less than resubmit_hours ago are not submitted again while their job is running
+## Returns the runs, the new runs in the order they should be submitted (carried over runs first) and the cache that was read
+def find_new_runs(project,workspace,bucket,s3_client=None,resubmit_hours=12,terra_client=None):
     # create dictionary of Terra entities (runs) and their submission IDs
     # get list of Terra entities (tables)
-    t = fapi.list_entity_types(project, workspace)
-    if t.status_code != 200:
-        print(t.text)
-        exit(1)
-    entity_types_json = t.json()
+    terra_client = terra_client or TerraClient()
+    entity_types_json = terra_client.list_entity_types(project, workspace)
     ## get list of Terra submissions
-    r = fapi.list_submissions(project, workspace)
-    fapi._check_response_code(r, 200)
     runs = {}
-    for elem in r.json():
+    for elem in terra_client.list_submissions(project, workspace):
         # remove '_set' from end of entity names
         entityType = re.sub('_set$', '', elem["submissionEntity"]["entityType"]) 
         entityst   = entityType in entity_types_json # check that the entity has data available
@@ -43,64 +178,103 @@ def terraRunChecker(project,workspace,bucket,jobqueue,jobdef,gcred):
     runs = {k: v for k, v in runs.items() if v[1] in most_recent and v == most_recent[v[1]]}
 
     # determine if there any new runs based on the submission IDs and existing ID cache
-    cache_key = f'cache/terra/{project}/{workspace}/'
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2( Bucket=bucket, Prefix=cache_key, Delimiter='/' )
-    if 'Contents' in response:
-        cache = []
-        for obj in response['Contents']:
-            cache.append(obj['Key'].replace(cache_key, ''))
-        newids = [id for id in list(runs.keys()) if id not in cache]
-        newruns = {key: runs[key] for key in newids if key in runs}
-    else:
-        newruns = runs
+    ## the cache is the manifest plus the IDs cached by batch jobs since it was last saved
+    s3_client = s3_client or boto3.client('s3')
+    manifest, _ = read_manifest(s3_client, bucket, f'cache/terra/{project}/{workspace}.manifest.json')
+    cached = list_cached_ids(s3_client, bucket, f'cache/terra/{project}/{workspace}/')
+    cache = set(manifest['ids']) | set(cached)
+    ## runs submitted by a recent check (snapshot) are not submitted again until resubmit_hours have passed
+    snapshot = manifest['snapshot']
+    print(f'{project}/{workspace}: {len(runs)} runs, {len(cache)} cached')
+    recent = time.time() - resubmit_hours*60*60
+    newruns = {id: run for id, run in runs.items() if id not in cache and snapshot.get(id, {}).get('submitted', 0) < recent}
+    queued = [id for id in manifest.get('queue', []) if id in newruns]
+    order = queued + [id for id in newruns if id not in queued]
 
-    # limit to 20 runs 
-    if len(newruns) > 10:
-        newruns = {k: newruns[k] for k in list(newruns)[:19]}
-    print(newruns)
-    
-    # submit a batch job for each new run
+    return {'project': project, 'workspace': workspace, 'runs': runs, 'newruns': newruns, 'order': order, 'cached': cached, 'cache': len(cache), 'run_lists': manifest.get('run_lists', {})}
+
+# Function for submitting the new runs found by find_new_runs and saving the manifest
+## granted = number of new runs that fit in the job queue (the others are carried over to the next check)
+## Run lists of array jobs that are done are deleted
+## Returns a report of the submissions found and the jobs submitted
+def submit_new_runs(found,granted,bucket,jobqueue,jobdef,gcred,s3_client=None,batch_client=None):
+    project, workspace, runs, newruns, order, cached = (found[k] for k in ['project', 'workspace', 'runs', 'newruns', 'order', 'cached'])
+    cache_key    = f'cache/terra/{project}/{workspace}/'
+    manifest_key = f'cache/terra/{project}/{workspace}.manifest.json'
+    s3_client    = s3_client or boto3.client('s3')
+    batch_client = batch_client or boto3.client('batch')
+
+    # submit the new runs that fit in the job queue, oldest carried over runs first
+    submit = {id: newruns[id] for id in order[:granted]}
+    carried = order[granted:]
+    print(f'{project}/{workspace}: submitting {list(submit)}, {len(carried)} runs carried over')
+    jobs, run_lists = submit_runs(batch_client, s3_client, project, workspace, submit, bucket, jobqueue, jobdef, gcred)
+
+    # remove the run lists of array jobs that are done
+    done = finished_run_lists(batch_client, found['run_lists'])
+    for i in range(0, len(done), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in done[i:i+1000]], 'Quiet': True})
+
+    # save the manifest: cached IDs, a snapshot of the current runs (with the time they were submitted) and the run lists in use
+    submitted = int(time.time())
+    def update(manifest):
+        old = manifest['snapshot']
+        manifest['ids'] = list(set(manifest['ids']) | set(cached))
+        manifest['snapshot'] = {id: {'workflow': run[0], 'entity': run[1], 'date': run[2], 'submitted': submitted if id in submit else old.get(id, {}).get('submitted', 0)} for id, run in runs.items()}
+        manifest['queue'] = carried
+        manifest['run_lists'] = {k: v for k, v in manifest.get('run_lists', {}).items() if k not in done}
+        manifest['run_lists'].update(run_lists)
+    update_manifest(s3_client, bucket, manifest_key, update)
+    delete_cached_ids(s3_client, bucket, cache_key, cached)
+
+    return {'submissions': len(runs), 'new': len(newruns), 'submitted': len(submit), 'carried': len(carried), 'cached': found['cache'], 'jobs': jobs}
+
+# Function for checking a workspace for new runs and submitting a batch job for each
+## max_runs = number of new runs that fit in the job queue (None submits every new run)
+## Returns a report of the submissions found and the jobs submitted
+def terraRunChecker(project,workspace,bucket,jobqueue,jobdef,gcred,s3_client=None,batch_client=None,resubmit_hours=12,max_runs=None,terra_client=None):
+    found = find_new_runs(project, workspace, bucket, s3_client, resubmit_hours, terra_client)
+    granted = len(found['order']) if max_runs is None else min(max_runs, len(found['order']))
+    return submit_new_runs(found, granted, bucket, jobqueue, jobdef, gcred, s3_client, batch_client)
+
+# Function for checking several workspaces concurrently
+## workspaces = list of [project, workspace]
+## Errors are reported per workspace so one failing workspace does not stop the others
+## max_jobs = number of jobs the job queue can hold (runs that do not fit are carried over to the next check)
+## New runs are found for all workspaces first, so the free slots can be shared between them before anything is submitted
+def checkWorkspaces(workspaces, bucket, jobqueue, jobdef, gcred, max_workers=4, resubmit_hours=12, max_jobs=20):
+    # clients are shared by all workers
+    s3_client    = boto3.client('s3')
     batch_client = boto3.client('batch')
-    for run in newruns:
-        response = batch_client.submit_job(
-                jobName=f'{project}_{workspace}_{run}',
-                jobQueue=jobqueue,
-                jobDefinition=jobdef,
-                containerOverrides={
-                    'environment': [
-                        {
-                            'name': 'TERRA_PROJECT',
-                            'value': project
-                        },
-                        {
-                            'name': 'TERRA_WORKSPACE',
-                            'value': workspace
-                        },
-                        {
-                            'name': 'TERRA_SUBMISSIONID',
-                            'value': run
-                        },
-                        {
-                            'name': 'TERRA_WORKFLOW',
-                            'value': newruns[run][0]
-                        },
-                        {
-                            'name': 'TERRA_SUBMISSIONENTITY',
-                            'value': newruns[run][1]
-                        },
-                        {
-                            'name': 'S3_OUTDIR',
-                            'value': bucket
-                        },
-                        {
-                            'name': 'GCRED',
-                            'value': gcred
-                        },
-                    ],
-                    'command': ['bash','-c','git clone https://github.com/DOH-JDJ0303/waphl-data.git && bash waphl-data/waphl-terra2res/aws-batch-script.sh $TERRA_PROJECT $TERRA_WORKSPACE $TERRA_SUBMISSIONID $TERRA_WORKFLOW $TERRA_SUBMISSIONENTITY $S3_OUTDIR $GCRED']
-                }
-            )
+    terra_client = TerraClient(pool_size=max_workers)
+
+    # free slots in the job queue
+    active = count_active_jobs(batch_client, jobqueue)
+    slots = max(max_jobs - active, 0)
+    print(f'{active} active jobs in {jobqueue}, {slots} free slots')
+
+    report = [{'project': project, 'workspace': workspace} for project, workspace in workspaces]
+    def find(r):
+        try:
+            return find_new_runs(r['project'], r['workspace'], bucket, s3_client, resubmit_hours, terra_client)
+        except Exception as e:
+            print(f'ERROR: {r["project"]}/{r["workspace"]}: {e}')
+            r['error'] = str(e)
+
+    def submit(r, found, granted):
+        try:
+            r.update(submit_new_runs(found, granted, bucket, jobqueue, jobdef, gcred, s3_client, batch_client))
+        except Exception as e:
+            print(f'ERROR: {r["project"]}/{r["workspace"]}: {e}')
+            r['error'] = str(e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = list(executor.map(find, report))
+        checked = [(r, f) for r, f in zip(report, found) if f is not None]
+        granted = share_slots(slots, [len(f['order']) for _, f in checked])
+        list(executor.map(lambda c: submit(*c[0], c[1]), zip(checked, granted)))
+    terra_client.print_stats()
+    return report
 
 def handler(event, context):
     # get secrets
@@ -131,6 +305,14 @@ def handler(event, context):
     aws_job_queue      = secret["aws_job_queue"]
     aws_job_def        = secret["aws_job_def"]
     google_credentials = secret["google_credentials"]
+    max_workers        = int(secret.get("max_workers", 4)) # workspaces checked at the same time
+    resubmit_hours     = int(secret.get("resubmit_hours", 12)) # hours before a run that has not been cached is submitted again
+    max_jobs           = int(secret.get("max_jobs", 20)) # jobs the job queue can hold (new runs are submitted until it is full)
+
+    # workspaces can also be supplied in the event (e.g., {"workspaces": ["workspace", "project/workspace"]})
+    if isinstance(event, dict) and event.get("workspaces"):
+        terra_workspaces = event["workspaces"]
+    workspaces = [ w.split('/', 1) if '/' in w else [terra_project, w] for w in terra_workspaces ]
 
     # set gcloud credentials
     s3_client    = boto3.client('s3')
@@ -141,9 +323,13 @@ def handler(event, context):
     s3_client.download_file(gcred_bucket, gcred_key, gcred_local)
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = gcred_local
 
-    # iterate over workspaces
-    for wksp in terra_workspaces:
-        terraRunChecker(terra_project, wksp, aws_results_bucket, aws_job_queue, aws_job_def, google_credentials)
+    # check workspaces
+    report = checkWorkspaces(workspaces, aws_results_bucket, aws_job_queue, aws_job_def, google_credentials, max_workers, resubmit_hours, max_jobs)
+    print(json.dumps(report))
+    failed = [ f'{r["project"]}/{r["workspace"]}' for r in report if 'error' in r ]
+    if failed:
+        raise RuntimeError(f'Unable to check {len(failed)} workspaces: {" ".join(failed)}')
+    return report
 
 # for dev
 # handler('test','test')